@@ -5,22 +5,52 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, url_for, redirect, request, flash, render_template
-from flask_caching import Cache
+import click
+from flask import Flask, url_for, redirect, request, flash, render_template, jsonify
 from flask_debugtoolbar import DebugToolbarExtension
 
+from caching import Cache
+
 app = Flask(__name__)
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 
 app.config['SECRET_KEY'] = 'dev key'
 
-app.config['CACHE_TYPE'] = 'simple'
+# 'simple' 后端把缓存保存在当前进程的字典中，使用多个工作进程运行程序时，
+# 每个进程都有一份独立的缓存，删除缓存也只对当前进程有效。
+# 设为 'backends.sqlite' 可以使用保存在SQLite文件中的缓存，所有进程共享同一份缓存，不需要额外运行缓存服务器；
+# 设为 'backends.bounded' 使用有内存上限的进程内缓存，按LRU或LFU策略淘汰，
+# 例如 qux 视图会为每个不同的 ?page= 创建缓存，有了内存上限，客户端构造大量查询参数也不会耗尽内存；
+# 也可以使用 Flask-Caching 内置的 'filesystem'、'redis' 等后端
+app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'simple')
+app.config['CACHE_SQLITE_PATH'] = os.getenv('CACHE_SQLITE_PATH')  # 默认为 instance/cache.sqlite
+app.config['CACHE_MAX_BYTES'] = int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024))  # 按序列化后的大小计算
+app.config['CACHE_EVICTION_POLICY'] = os.getenv('CACHE_EVICTION_POLICY', 'lru')  # 'lru' 或 'lfu'
+# 压缩缓存的页面，减少缓存后端占用的内存：'gzip' 或 'lzma'，只压缩不小于 CACHE_COMPRESSION_THRESHOLD 字节的页面；
+# 使用 'gzip' 时，对于支持 gzip 的浏览器（Accept-Encoding: gzip）直接返回压缩后的数据，不需要解压和重新压缩
+app.config['CACHE_COMPRESSION'] = os.getenv('CACHE_COMPRESSION')
+app.config['CACHE_COMPRESSION_THRESHOLD'] = int(os.getenv('CACHE_COMPRESSION_THRESHOLD', 1024))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
+# flask cache warm 预先访问的页面，部署或清空缓存后执行，让第一批访客也能命中缓存
+app.config['CACHE_WARM_URLS'] = ['/bar', '/baz'] + ['/qux?page=%d' % page for page in range(1, 6)]
+
 cache = Cache(app)
+# caching.Cache 继承自 Flask-Caching 的 Cache 类，cached() 和 memoize() 增加了 single_flight 参数：
+# 缓存过期后同时到达的多个请求中，只有一个会执行视图函数，其他请求等待它的结果，避免同时执行多次耗时的计算；
+# cached() 的 stale_ttl 参数：缓存过期后的 stale_ttl 秒内仍然返回过期的缓存，同时在后台线程中重新生成，
+# 这样缓存过期后的第一个用户也不需要等待耗时的计算；
+# tags 参数为缓存分组，调用 cache.invalidate_tags() 即可让同一标签下的所有缓存失效，而不必清空整个缓存；
+# cache.stats 按键前缀（视图的 URL 或函数名）记录命中、未命中、写入和删除次数，计算耗时和值的大小
 toolbar = DebugToolbarExtension(app)
 
 
@@ -36,21 +66,21 @@ def foo():
 
 
 @app.route('/bar')
-@cache.cached(timeout=10 * 60)
+@cache.cached(timeout=10 * 60, stale_ttl=60 * 60, single_flight=True)
 def bar():
     time.sleep(1)
     return render_template('bar.html')
 
 
 @app.route('/baz')
-@cache.cached(timeout=60 * 60)
+@cache.cached(timeout=60 * 60, stale_ttl=24 * 60 * 60, single_flight=True)
 def baz():
     time.sleep(1)
     return render_template('baz.html')
 
 
 @app.route('/qux')
-@cache.cached(query_string=True)
+@cache.cached(query_string=True, single_flight=True, tags=['qux'])
 def qux():
     time.sleep(1)
     page = request.args.get('page', 1)
@@ -71,6 +101,14 @@ def update_baz():
     return redirect(url_for('index'))
 
 
+# 每个 ?page= 对应一个缓存，无法逐个删除，通过标签一次性让它们全部失效
+@app.route('/update/qux')
+def update_qux():
+    cache.invalidate_tags('qux')
+    flash('Cached data for all qux pages have been deleted.')
+    return redirect(url_for('index'))
+
+
 @app.route('/update/all')
 def update_all():
     cache.clear()
@@ -78,24 +116,191 @@ def update_all():
     return redirect(url_for('index'))
 
 
+# 缓存统计，JSON 格式，不依赖调试工具栏，生产环境也可以查看；
+# 每个工作进程有独立的计数器，返回的是处理这个请求的进程的统计
+@app.route('/cache/stats')
+def cache_stats():
+    stats = cache.stats.snapshot()
+    stats['pid'] = os.getpid()
+    if hasattr(cache.cache, 'stats'):  # backends.BoundedCache 提供后端自身的统计
+        stats['backend'] = cache.cache.stats()
+    return jsonify(stats)
+
+
+# Prometheus 文本格式，供 Prometheus 抓取
+@app.route('/metrics')
+def metrics():
+    return cache.stats.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 # cache other function
-@cache.cached(key_prefix='add')
+@cache.cached(key_prefix='add', tags=['math'])
 def add(a, b):
     time.sleep(2)
     return a + b
 
 
 # cache memorize (with argument)
-@cache.memoize()
+# local_ttl：结果同时在当前进程的字典中保存 10 秒，重复调用不必访问缓存后端
+@cache.memoize(single_flight=True, tags=['math'], local_ttl=10)
 def add_pro(a, b):
     time.sleep(2)
     return a + b
 
 
 def del_add_cache():
-    cache.delete('add')
+    cache.delete(add.make_cache_key())  # 键中包含标签的版本号，不能直接使用 'add'
 
 
 # delete memorized cache
 def del_pro_cache():
     cache.delete_memoized(add_pro)
+
+
+# delete cache for both add and add_pro
+def del_math_cache():
+    cache.invalidate_tags('math')
+
+
+# 命令组 flask cache <子命令>
+@app.cli.group('cache')
+def cache_cli():
+    """Cache management commands."""
+
+
+def _bench_worker(args):     # 在子进程中运行，返回 (命中次数, 未命中次数)
+    requests, pages, seed = args
+    random.seed(seed)
+    client = app.test_client()
+    hits = misses = 0
+    for _ in range(requests):
+        start = time.time()
+        client.get('/qux?page=%d' % random.randint(1, pages))
+        if time.time() - start < 0.5:   # 视图函数中有 time.sleep(1)，耗时很短说明命中了缓存
+            hits += 1
+        else:
+            misses += 1
+    return hits, misses
+
+
+@cache_cli.command('bench')
+@click.option('--processes', default=4, help='Number of worker processes.')
+@click.option('--requests', default=20, help='Requests sent by each process.')
+@click.option('--pages', default=5, help='Number of distinct /qux?page= variants.')
+def bench_cache(processes, requests, pages):
+    """Measure the cache hit rate with several worker processes."""
+    with app.app_context():
+        cache.clear()
+    pool = multiprocessing.Pool(processes)
+    start = time.time()
+    results = pool.map(_bench_worker, [(requests, pages, seed) for seed in range(processes)])
+    pool.close()
+    pool.join()
+    hits = sum(result[0] for result in results)
+    misses = sum(result[1] for result in results)
+    click.echo('%s backend, %d processes: %d hits, %d misses (hit rate %.1f%%, at best %.1f%%) in %.1fs'
+               % (app.config['CACHE_TYPE'], processes, hits, misses, 100.0 * hits / (hits + misses),
+                  100.0 * (hits + misses - pages) / (hits + misses), time.time() - start))
+
+
+@cache_cli.command('check-single-flight')
+@click.option('--clients', default=20, help='Number of concurrent requests.')
+def check_single_flight(clients):
+    """Check that concurrent misses of /qux compute the page once, on each backend."""
+    # 多个请求同时访问同一个未缓存的页面，single_flight 应该只让其中一个执行视图函数；
+    # 依次在 'simple' 和 'backends.sqlite' 后端上检查，SQLite 缓存使用临时文件，不影响实际的缓存
+    failed = []
+    try:
+        for backend in ('simple', 'backends.sqlite'):
+            path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+            cache.init_app(app, config={'CACHE_TYPE': backend, 'CACHE_SQLITE_PATH': path})
+            barrier = threading.Barrier(clients)
+            statuses = []
+
+            def get(i):
+                barrier.wait()  # 所有请求同时发出
+                statuses.append(app.test_client().get('/qux?page=single-flight').status_code)
+
+            with ThreadPoolExecutor(clients) as executor:
+                list(executor.map(get, range(clients)))
+            computes = cache.stats.snapshot()['prefixes'].get('view//qux', {}).get('computes', 0)
+            ok = computes == 1 and statuses == [200] * clients
+            click.echo('%-16s %d concurrent misses, %d computation(s)  %s'
+                       % (backend, clients, computes, 'ok' if ok else 'FAILED'))
+            if not ok:
+                failed.append(backend)
+    finally:
+        cache.init_app(app)     # 恢复 CACHE_TYPE 配置的后端
+    if failed:
+        raise click.ClickException('single_flight did not hold on %s.' % ', '.join(failed))
+
+
+# 缓存只保存在当前进程中的后端
+LOCAL_CACHE_TYPES = ('null', 'simple', 'uwsgi', 'backends.bounded')
+
+# 预先调用的函数 (函数, 位置参数, 关键字参数)
+app.config['CACHE_WARM_CALLS'] = [(add, (1, 2), {}), (add_pro, (1, 2), {})]
+
+
+def _warm_url(url, force):
+    with app.test_request_context(url):
+        if request.endpoint is None:    # 没有匹配的路由（404 或 405），不发送请求，报告为失败
+            return url, None, getattr(request.routing_exception, 'code', 404), False, 0.0
+        view = app.view_functions[request.endpoint]
+        key = view.make_cache_key() if hasattr(view, 'make_cache_key') else None
+        if force and key is not None:
+            cache.delete(key)
+        was_cached = key is not None and cache.get(key) is not None
+    start = time.time()
+    status = app.test_client().get(url).status_code
+    return url, key, status, was_cached, time.time() - start
+
+
+def _warm_call(f, args, kwargs, force):
+    memoized = hasattr(f, 'delete_memoized')   # memoize() 装饰的函数
+    with app.app_context():
+        if memoized:
+            if force:
+                cache.delete_memoized(f, *args, **kwargs)
+            key = f.make_cache_key(f.uncached, *args, **kwargs)
+        else:
+            key = f.make_cache_key(*args, **kwargs)
+            if force:
+                cache.delete(key)
+        was_cached = cache.get(key) is not None
+        start = time.time()
+        f(*args, **kwargs)
+    name = '%s(%s)' % (f.__name__, ', '.join([repr(arg) for arg in args] +
+                                             ['%s=%r' % item for item in sorted(kwargs.items())]))
+    return name, key, 200, was_cached, time.time() - start
+
+
+@cache_cli.command('warm')
+@click.option('--workers', default=4, help='Number of parallel requests.')
+@click.option('--force', is_flag=True, help='Recompute entries that are already cached.')
+def warm_cache(workers, force):
+    """Populate the cache for the configured URLs and function calls."""
+    # 进程内的缓存（simple、backends.bounded 等）只保存在执行命令的进程中，命令结束后就消失了，
+    # 服务器进程什么也得不到，所以只对多个进程共享的后端（backends.sqlite、filesystem、redis、memcached）预热
+    if app.config['CACHE_TYPE'] in LOCAL_CACHE_TYPES:
+        raise click.ClickException('CACHE_TYPE %r keeps the cache in this process only, so warming it has no effect '
+                                   'on the server; use a shared backend such as backends.sqlite or redis.'
+                                   % app.config['CACHE_TYPE'])
+    # 使用测试客户端在多个线程中并行请求，不需要启动服务器
+    start = time.time()
+    with ThreadPoolExecutor(workers) as executor:
+        jobs = [executor.submit(_warm_url, url, force) for url in app.config['CACHE_WARM_URLS']]
+        jobs += [executor.submit(_warm_call, f, args, kwargs, force)
+                 for f, args, kwargs in app.config['CACHE_WARM_CALLS']]
+        results = [job.result() for job in jobs]
+    warmed = 0
+    for name, key, status, was_cached, elapsed in results:
+        if status != 200:
+            state = 'failed (%d)' % status
+        elif was_cached:
+            state = 'already cached'
+        else:
+            state = 'warmed'
+            warmed += 1
+        click.echo('%-20s %-16s %6.2fs  %s' % (name, state, elapsed, key))
+    click.echo('Warmed %d of %d entries in %.2fs.' % (warmed, len(results), time.time() - start))
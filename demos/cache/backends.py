@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+    Extra cache backends for Flask-Caching.
+
+    Set CACHE_TYPE to the import path of a factory function, e.g.
+    ``app.config['CACHE_TYPE'] = 'backends.sqlite'``.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from werkzeug.contrib.cache import BaseCache
+
+
+class SQLiteCache(BaseCache):
+    """Cache stored in a SQLite database file.
+
+    Every worker process opens the same file, so a value set or deleted by one
+    worker is immediately visible to all the others, without running a cache
+    server. WAL mode lets readers proceed while another process writes.
+    """
+
+    def __init__(self, path, default_timeout=300, threshold=10000):
+        super(SQLiteCache, self).__init__(default_timeout)
+        self._path = path
+        self._threshold = threshold
+        self._local = threading.local()
+        self._sets = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection().execute('CREATE TABLE IF NOT EXISTS cache '
+                                   '(key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads or across fork(),
+        # so keep one connection per thread and reopen it in a forked child.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout > 0 else 0  # 0 means never expire
+
+    def _prune(self, connection):
+        connection.execute('DELETE FROM cache WHERE expires != 0 AND expires <= ?', (time.time(),))
+        count = connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count > self._threshold:  # drop the entries closest to expiry
+            connection.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                               'ORDER BY expires = 0, expires LIMIT ?)', (count - self._threshold,))
+
+    def get(self, key):
+        row = self._connection().execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] and row[1] <= time.time()):
+            return None
+        try:
+            return pickle.loads(row[0])
+        except (pickle.PickleError, EOFError):
+            return None
+
+    def set(self, key, value, timeout=None):
+        connection = self._connection()
+        self._sets += 1
+        if self._sets % 100 == 0:
+            self._prune(connection)
+        connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                           (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                            self._expires(timeout)))
+        return True
+
+    def add(self, key, value, timeout=None):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')  # take the write lock, so check-and-insert is atomic
+        try:
+            connection.execute('DELETE FROM cache WHERE key = ? AND expires != 0 AND expires <= ?',
+                               (key, time.time()))
+            cursor = connection.execute('INSERT OR IGNORE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                                        (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                                         self._expires(timeout)))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        cursor = self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+        return cursor.rowcount == 1
+
+    def has(self, key):
+        row = self._connection().execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+        return row is not None and (not row[0] or row[0] > time.time())
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+        return True
+
+    def inc(self, key, delta=1):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            value = (self.get(key) or 0) + delta
+            # keep the expiry of a live entry; an expired one counts as missing and gets the default timeout
+            row = connection.execute('SELECT expires FROM cache WHERE key = ? AND (expires = 0 OR expires > ?)',
+                                     (key, time.time())).fetchone()
+            connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                               (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                                row[0] if row else self._expires(None)))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+
+class BoundedCache(BaseCache):
+    """In-process cache bounded by entry count and by memory.
+
+    Values are pickled when stored, as in SimpleCache, and the size of the
+    pickled value plus its key is charged against ``max_bytes``. When either
+    limit is exceeded, entries are evicted in least recently used (``'lru'``)
+    or least frequently used (``'lfu'``) order, so a client producing many
+    distinct keys (``?page=1``, ``?page=2``...) can only push out cold entries
+    and never grow the cache past its budget.
+    """
+
+    def __init__(self, default_timeout=300, max_bytes=64 * 1024 * 1024, max_entries=None, policy='lru'):
+        super(BoundedCache, self).__init__(default_timeout)
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('policy must be "lru" or "lfu", got %r' % policy)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.policy = policy
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (expires, pickled value, size), in LRU order
+        self._bytes = 0
+        # LFU bookkeeping: access count per key, and keys grouped by count in insertion order
+        self._counts = {}
+        self._buckets = defaultdict(OrderedDict)
+        self._min_count = 0
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout > 0 else 0
+
+    def _touch(self, key):
+        if self.policy == 'lru':
+            self._entries.move_to_end(key)
+            return
+        count = self._counts[key]
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+        self._counts[key] = count + 1
+        self._buckets[count + 1][key] = None
+
+    def _remove(self, key):
+        expires, data, size = self._entries.pop(key)
+        self._bytes -= size
+        if self.policy == 'lfu':
+            count = self._counts.pop(key)
+            bucket = self._buckets[count]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[count]
+
+    def _victim(self):
+        if self.policy == 'lru':
+            return next(iter(self._entries))
+        if self._min_count not in self._buckets:  # the minimum bucket was emptied by a delete
+            self._min_count = min(self._buckets)
+        return next(iter(self._buckets[self._min_count]))
+
+    def _evict(self, size):
+        while self._entries and (self._bytes + size > self.max_bytes or
+                                 (self.max_entries and len(self._entries) >= self.max_entries)):
+            self._remove(self._victim())
+            self.evictions += 1
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] and entry[0] <= time.time():
+            self._remove(key)
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(key)
+        try:
+            return pickle.loads(entry[1])
+        except (pickle.PickleError, EOFError):
+            return None
+
+    def set(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = len(data) + len(key)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            count = 1
+            if key in self._entries:
+                count = self._counts.get(key, 1)  # a refreshed hot key keeps its frequency
+                self._remove(key)
+            self._evict(size)
+            self._entries[key] = (self._expires(timeout), data, size)
+            self._bytes += size
+            if self.policy == 'lfu':
+                self._counts[key] = count
+                self._buckets[count][key] = None
+                self._min_count = min(self._min_count, count) if len(self._entries) > 1 else count
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._get_entry(key) is not None:
+                return False
+            return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def has(self, key):
+        with self._lock:
+            return self._get_entry(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counts.clear()
+            self._buckets.clear()
+            self._bytes = 0
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            value = (self.get(key) or 0) + delta
+            return value if self.set(key, value) else None
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def stats(self):
+        with self._lock:
+            return dict(policy=self.policy, hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+
+
+def bounded(app, config, args, kwargs):
+    kwargs.update(dict(max_bytes=config.get('CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                       max_entries=config['CACHE_THRESHOLD'],
+                       policy=config.get('CACHE_EVICTION_POLICY', 'lru')))
+    return BoundedCache(*args, **kwargs)
+
+
+def sqlite(app, config, args, kwargs):
+    path = config.get('CACHE_SQLITE_PATH') or os.path.join(app.instance_path, 'cache.sqlite')
+    kwargs.update(dict(path=path, threshold=config['CACHE_THRESHOLD']))
+    return SQLiteCache(*args, **kwargs)
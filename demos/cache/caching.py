@@ -0,0 +1,599 @@
+# -*- coding: utf-8 -*-
+"""
+    Flask-Caching's Cache with extra options for cached views and memoized functions.
+"""
+import base64
+import functools
+import hashlib
+import logging
+import lzma
+import pickle
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, request, has_request_context, copy_current_request_context
+from flask_caching import Cache as _Cache, function_namespace
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the value size histogram, in bytes of the pickled value
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def stable_repr(value, _active=frozenset()):
+    """``repr()`` that does not depend on the process.
+
+    Dicts and sets are sorted (set order changes with string hash
+    randomization) and objects without a ``__repr__`` of their own are
+    described by their class and attributes rather than their address, so
+    every worker builds the same memoize key for the same arguments.
+    Objects without a ``__dict__`` (``__slots__``) keep their ``repr()``, and
+    a container met again inside itself is printed as ``...``.
+    """
+    cls = type(value)
+    if isinstance(value, (dict, set, frozenset, list, tuple)) or cls.__repr__ is object.__repr__:
+        if id(value) in _active:  # reference cycle
+            return '...'
+        _active = _active | {id(value)}
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted('%s: %s' % (stable_repr(key, _active), stable_repr(item, _active))
+                                         for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return '%s({%s})' % (cls.__name__, ', '.join(sorted(stable_repr(item, _active) for item in value)))
+    if isinstance(value, (list, tuple)):
+        return '%s(%s)' % (cls.__name__, ', '.join(stable_repr(item, _active) for item in value))
+    if cls.__repr__ is object.__repr__ and hasattr(value, '__dict__'):
+        return '%s.%s(%s)' % (cls.__module__, cls.__qualname__, stable_repr(value.__dict__, _active))
+    return repr(value)
+
+
+def _typed(value):
+    """Pair ``value`` with its type, so that ``1``, ``1.0`` and ``True`` make different dict keys."""
+    if isinstance(value, tuple):
+        return type(value), tuple(_typed(item) for item in value)
+    return type(value), value
+
+
+def key_label(cache_key):
+    """Group keys by what they cache: ``view//qux?<args>#<tags>`` counts as ``view//qux``."""
+    return cache_key.split('?', 1)[0].split('#', 1)[0]
+
+
+class CacheStats(object):
+    """Counters of the cached views and memoized functions, by key prefix.
+
+    Records hits, misses, sets and deletes, the time spent computing the
+    values and the sizes of the stored values. Every hit is credited with the
+    mean compute time of its prefix, which estimates the latency the cache
+    saved. The counters live in the process, like Prometheus client metrics,
+    so with several workers each process reports its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prefixes = {}
+        self.started = time.time()
+
+    def _get(self, prefix):
+        counters = self._prefixes.get(prefix)
+        if counters is None:
+            counters = self._prefixes[prefix] = dict(
+                hits=0, local_hits=0, misses=0, sets=0, deletes=0, computes=0, compute_seconds=0.0, saved_seconds=0.0,
+                sizes=[0] * (len(SIZE_BUCKETS) + 1), size_bytes=0)
+        return counters
+
+    def hit(self, prefix, local=False):
+        with self._lock:
+            counters = self._get(prefix)
+            counters['hits'] += 1
+            if local:  # answered by the per-process tier of memoize(local_ttl=...)
+                counters['local_hits'] += 1
+            if counters['computes']:
+                counters['saved_seconds'] += counters['compute_seconds'] / counters['computes']
+
+    def miss(self, prefix):
+        with self._lock:
+            self._get(prefix)['misses'] += 1
+
+    def computed(self, prefix, seconds):
+        with self._lock:
+            counters = self._get(prefix)
+            counters['computes'] += 1
+            counters['compute_seconds'] += seconds
+
+    def stored(self, prefix, value):
+        try:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:  # the backend may still store it some other way
+            size = 0
+        bucket = len(SIZE_BUCKETS)
+        for index, bound in enumerate(SIZE_BUCKETS):
+            if size <= bound:
+                bucket = index
+                break
+        with self._lock:
+            counters = self._get(prefix)
+            counters['sets'] += 1
+            counters['sizes'][bucket] += 1
+            counters['size_bytes'] += size
+
+    def deleted(self, prefix, count=1):
+        with self._lock:
+            self._get(prefix)['deletes'] += count
+
+    def reset(self):
+        with self._lock:
+            self._prefixes.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        """Return the counters as a dict, ready for ``jsonify()``."""
+        with self._lock:
+            prefixes = dict((prefix, dict(counters, sizes=list(counters['sizes'])))
+                            for prefix, counters in self._prefixes.items())
+        totals = dict(hits=0, misses=0, sets=0, deletes=0, saved_seconds=0.0)
+        for counters in prefixes.values():
+            lookups = counters['hits'] + counters['misses']
+            counters['hit_rate'] = float(counters['hits']) / lookups if lookups else None
+            counters['mean_compute_seconds'] = (counters['compute_seconds'] / counters['computes']
+                                                if counters['computes'] else None)
+            bounds = [str(bound) for bound in SIZE_BUCKETS] + ['+Inf']
+            counters['sizes'] = dict(zip(bounds, counters['sizes']))
+            for name in totals:
+                totals[name] += counters[name]
+        return dict(uptime_seconds=time.time() - self.started, totals=totals, prefixes=prefixes)
+
+    def prometheus(self, namespace='flask_cache'):
+        """Return the counters in the Prometheus text exposition format."""
+        with self._lock:
+            prefixes = sorted((prefix, dict(counters, sizes=list(counters['sizes'])))
+                              for prefix, counters in self._prefixes.items())
+        lines = []
+
+        def metric(name, kind, help_text, field):
+            lines.append('# HELP %s_%s %s' % (namespace, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (namespace, name, kind))
+            for prefix, counters in prefixes:
+                lines.append('%s_%s{prefix="%s"} %s' % (namespace, name, _escape(prefix), counters[field]))
+
+        metric('hits_total', 'counter', 'Lookups answered from the cache.', 'hits')
+        metric('local_hits_total', 'counter', 'Hits answered by the per-process tier.', 'local_hits')
+        metric('misses_total', 'counter', 'Lookups not found in the cache.', 'misses')
+        metric('sets_total', 'counter', 'Values stored in the cache.', 'sets')
+        metric('deletes_total', 'counter', 'Entries deleted or invalidated.', 'deletes')
+        metric('compute_seconds_total', 'counter', 'Time spent computing values on misses.', 'compute_seconds')
+        metric('saved_seconds_total', 'counter', 'Estimated compute time saved by hits.', 'saved_seconds')
+        name = '%s_value_bytes' % namespace
+        lines.append('# HELP %s Size of the stored values, pickled.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for prefix, counters in prefixes:
+            label = _escape(prefix)
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in SIZE_BUCKETS] + ['+Inf'], counters['sizes']):
+                cumulative += count
+                lines.append('%s_bucket{prefix="%s",le="%s"} %d' % (name, label, bound, cumulative))
+            lines.append('%s_sum{prefix="%s"} %d' % (name, label, counters['size_bytes']))
+            lines.append('%s_count{prefix="%s"} %d' % (name, label, counters['sets']))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Cache(_Cache):
+
+    def __init__(self, app=None, with_jinja2_ext=True, config=None):
+        # per-process tiers of the functions memoized with local_ttl, as (tags, dict)
+        self._local_caches = []
+        super(Cache, self).__init__(app, with_jinja2_ext, config)
+
+    def init_app(self, app, config=None):
+        # seconds a single-flight leader may hold the recompute lock before
+        # waiting callers give up and compute the value themselves
+        app.config.setdefault('CACHE_LOCK_TIMEOUT', 10)
+        app.config.setdefault('CACHE_LOCK_POLL_INTERVAL', 0.05)
+        app.config.setdefault('CACHE_DEFAULT_TIMEOUT', 300)
+        # size of the thread pool regenerating stale entries in the background
+        app.config.setdefault('CACHE_REFRESH_WORKERS', 4)
+        # answer If-None-Match / If-Modified-Since on cached views with 304 Not Modified;
+        # CACHE_HTTP_MAX_AGE > 0 lets browsers and proxies reuse a page without asking,
+        # 0 sends "no-cache" so they revalidate every time (and see invalidations at once)
+        app.config.setdefault('CACHE_HTTP_CONDITIONAL', True)
+        app.config.setdefault('CACHE_HTTP_MAX_AGE', 0)
+        # compress cached pages of at least CACHE_COMPRESSION_THRESHOLD bytes: 'gzip' entries are
+        # sent as they are to clients accepting gzip, 'lzma' ones are smaller but always decompressed
+        app.config.setdefault('CACHE_COMPRESSION', None)
+        app.config.setdefault('CACHE_COMPRESSION_THRESHOLD', 1024)
+        app.config.setdefault('CACHE_COMPRESSION_LEVEL', 6)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.stats = CacheStats()
+        # entries kept by each function memoized with local_ttl
+        app.config.setdefault('CACHE_LOCAL_MAX_ENTRIES', 1024)
+        super(Cache, self).init_app(app, config)
+
+    def clear(self):
+        for tags, local_cache in self._local_caches:
+            local_cache.clear()
+        return super(Cache, self).clear()
+
+    def delete(self, *args, **kwargs):
+        if args:
+            self.stats.deleted(key_label(args[0]))
+        return super(Cache, self).delete(*args, **kwargs)
+
+    def delete_many(self, *args, **kwargs):
+        for key in args:
+            self.stats.deleted(key_label(key))
+        return super(Cache, self).delete_many(*args, **kwargs)
+
+    def delete_memoized(self, f, *args, **kwargs):
+        if callable(f):
+            self.stats.deleted(function_namespace(f)[0])
+            local_cache = getattr(f, 'local_cache', None)
+            if local_cache is not None:  # the same arguments may be cached under several local keys
+                local_cache.clear()
+        return super(Cache, self).delete_memoized(f, *args, **kwargs)
+
+    def _view_key(self, key_prefix, query_string):
+        if callable(key_prefix):
+            return key_prefix()
+        if '%s' not in key_prefix:  # plain function cached under a fixed key
+            return key_prefix
+        cache_key = key_prefix % request.path
+        if query_string:
+            # sort the arguments so ?a=1&b=2 and ?b=2&a=1 share an entry
+            args = sorted((key, sorted(values)) for key, values in request.args.lists())
+            cache_key += '?' + hashlib.md5(repr(args).encode('utf-8')).hexdigest()
+        return cache_key
+
+    def _coalesce(self, cache_key, compute):
+        """Run ``compute()`` in one caller only while the others wait for its result.
+
+        The lock is an entry added with ``cache.add()``, which is atomic in the
+        backends, so with a shared backend only one worker process recomputes
+        a missing key.
+        """
+        config = current_app.config
+        lock_key = 'lock/%s' % cache_key
+        deadline = time.time() + config['CACHE_LOCK_TIMEOUT']
+        while True:
+            if self.cache.add(lock_key, 1, timeout=config['CACHE_LOCK_TIMEOUT']):
+                try:
+                    rv = self.cache.get(cache_key)  # the previous leader may have just finished
+                    return compute() if rv is None else rv
+                finally:
+                    self.cache.delete(lock_key)
+            time.sleep(config['CACHE_LOCK_POLL_INTERVAL'])
+            rv = self.cache.get(cache_key)
+            if rv is not None:
+                return rv
+            if time.time() > deadline:  # the leader died or is too slow
+                return compute()
+
+    def _compress(self, entry, body, method):
+        level = current_app.config['CACHE_COMPRESSION_LEVEL']
+        if method == 'gzip':  # gzip container (wbits=31), so the bytes can be sent with Content-Encoding: gzip
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            data = compressor.compress(body) + compressor.flush()
+        elif method == 'lzma':
+            data = lzma.compress(body, preset=level)
+        else:
+            raise ValueError('Unknown compression %r, use "gzip" or "lzma".' % method)
+        entry.update(data=data, encoding=method, text=isinstance(entry.pop('value'), str))
+
+    def _decompress(self, entry):
+        if 'encoding' not in entry:
+            return entry['value']
+        if entry['encoding'] == 'gzip':
+            body = zlib.decompress(entry['data'], 31)
+        else:
+            body = lzma.decompress(entry['data'])
+        return body.decode('utf-8') if entry['text'] else body
+
+    def _conditional_response(self, response, entry, etag):
+        config = current_app.config
+        response.set_etag(etag)
+        response.last_modified = int(entry['last_modified'])
+        max_age = config['CACHE_HTTP_MAX_AGE']
+        if entry['fresh_until']:
+            max_age = min(max_age, int(entry['fresh_until'] - time.time()))
+        if max_age > 0:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def _view_response(self, entry):
+        """Build the response of a cached view, from the compressed bytes when the client accepts them."""
+        etag = entry.get('etag') if current_app.config['CACHE_HTTP_CONDITIONAL'] else None
+        # Flask-DebugToolbar decodes HTML responses as text to insert itself,
+        # which fails on gzip bytes: decompress while it is enabled
+        pass_through = request.accept_encodings['gzip'] and not current_app.config.get('DEBUG_TB_ENABLED')
+        if entry.get('encoding') == 'gzip' and pass_through:
+            response = current_app.response_class(entry['data'])
+            response.headers['Content-Encoding'] = 'gzip'
+            if etag:
+                etag += '-gz'  # another representation of the page, so another ETag
+        elif 'encoding' in entry or etag:
+            response = current_app.make_response(self._decompress(entry))
+        else:
+            return entry['value']
+        if 'encoding' in entry:
+            response.vary.add('Accept-Encoding')
+        if etag:
+            return self._conditional_response(response, entry, etag)
+        return response
+
+    def _refresh_in_background(self, cache_key, compute):
+        """Schedule ``compute()`` on the refresh pool, unless a refresh of the key is running."""
+        config = current_app.config
+        lock_key = 'refresh/%s' % cache_key
+        if not self.cache.add(lock_key, 1, timeout=config['CACHE_LOCK_TIMEOUT']):
+            return
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(config['CACHE_REFRESH_WORKERS'])
+        app = current_app._get_current_object()
+        if has_request_context():  # views need the request (url_for, request.args...) after it ends
+            compute = copy_current_request_context(compute)
+
+        def refresh():
+            with app.app_context():
+                try:
+                    compute()
+                except Exception:
+                    logger.exception('Failed to refresh cache entry %s.', cache_key)
+                finally:
+                    self.cache.delete(lock_key)
+
+        self._executor.submit(refresh)
+
+    def _tag_versions(self, tags):
+        keys = ['tag/%s' % tag for tag in tags]
+        versions = list(self.cache.get_many(*keys))
+        if None in versions:
+            for key, version in zip(keys, versions):
+                if version is None:
+                    self.cache.add(key, self._memoize_make_version_hash(), timeout=0)
+            versions = list(self.cache.get_many(*keys))
+        return '.'.join(versions)
+
+    def invalidate_tags(self, *tags):
+        """Invalidate every entry cached with any of ``tags``.
+
+        Each tag has a generation stored in the cache and appended to the keys
+        of its entries; replacing the generation makes all of them unreachable
+        with one write per tag, and the orphaned entries expire on their own.
+        """
+        for tag in tags:
+            self.stats.deleted('tag/%s' % tag)
+        for local_tags, local_cache in self._local_caches:
+            if set(local_tags) & set(tags):
+                local_cache.clear()
+        self.cache.set_many(dict(('tag/%s' % tag, self._memoize_make_version_hash()) for tag in tags), timeout=0)
+
+    def _memoize_version(self, f, args=None, reset=False, delete=False, timeout=None, forced_update=False):
+        # Flask-Caching creates a missing version with set_many(), so callers racing on a
+        # cold function each pick their own version, hence their own cache key, and all
+        # of them compute. Create it with add() instead so the first caller wins.
+        if reset or delete:
+            return super(Cache, self)._memoize_version(f, args=args, reset=reset, delete=delete,
+                                                       timeout=timeout, forced_update=forced_update)
+        fname, instance_fname = function_namespace(f, args=args)
+        fetch_keys = [self._memvname(name) for name in (fname, instance_fname) if name]
+        versions = list(self.cache.get_many(*fetch_keys))
+        if None in versions:
+            for key, version in zip(fetch_keys, versions):
+                if version is None:
+                    self.cache.add(key, self._memoize_make_version_hash(), timeout=timeout)
+            versions = list(self.cache.get_many(*fetch_keys))
+        elif callable(forced_update) and forced_update() is True:  # refresh the TTL
+            self.cache.set_many(dict(zip(fetch_keys, versions)), timeout=timeout)
+        return fname, ''.join(versions)
+
+    def _memoize_make_cache_key(self, make_name=None, timeout=None, forced_update=False):
+        # Flask-Caching hashes the repr() of the arguments, which differs between
+        # processes for sets and for objects printed with their address
+        def make_cache_key(f, *args, **kwargs):
+            fname, version_data = self._memoize_version(
+                f, args=args, timeout=getattr(timeout, 'cache_timeout', timeout), forced_update=forced_update)
+            altfname = make_name(fname) if callable(make_name) else fname
+            if callable(f):
+                args, kwargs = self._memoize_kwargs_to_args(f, *args, **kwargs)
+            updated = '%s%s%s' % (altfname, stable_repr(args), stable_repr(kwargs))
+            cache_key = base64.b64encode(hashlib.md5(updated.encode('utf-8')).digest())[:16].decode('utf-8')
+            return cache_key + version_data
+        return make_cache_key
+
+    def cached(self, timeout=None, key_prefix='view/%s', unless=None, forced_update=None,
+               query_string=False, single_flight=False, stale_ttl=None, tags=(), compression=None):
+        """Cache the return value of a view or function.
+
+        Keys are built like Flask-Caching does: ``key_prefix % request.path``
+        for views, or ``key_prefix`` itself for other functions. With
+        ``single_flight=True``, concurrent misses of the same key run the
+        function once and share its result. With ``stale_ttl``, an entry is
+        kept that many seconds past its timeout and served while a background
+        worker regenerates it. ``tags`` groups entries for :meth:`invalidate_tags`.
+
+        Entries of views returning a string also store an ETag and a
+        Last-Modified date, and conditional requests are answered with
+        304 Not Modified. Hits, misses and compute times are recorded in
+        :attr:`stats` under the key without its query string and tags.
+
+        ``compression`` (``'gzip'``, ``'lzma'`` or ``False``, defaults to
+        ``CACHE_COMPRESSION``) compresses string values of at least
+        ``CACHE_COMPRESSION_THRESHOLD`` bytes before storing them.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                if callable(unless) and unless() is True:
+                    return f(*args, **kwargs)
+                forced = callable(forced_update) and forced_update() is True
+                try:
+                    cache_key = decorated_function.make_cache_key(*args, **kwargs)
+                    entry = None if forced else self.cache.get(cache_key)
+                except Exception:
+                    if current_app.debug:
+                        raise
+                    logger.exception('Exception possibly due to cache backend.')
+                    return f(*args, **kwargs)
+
+                label = key_label(cache_key)
+
+                def compute():
+                    start = time.time()
+                    rv = f(*args, **kwargs)
+                    self.stats.computed(label, time.time() - start)
+                    timeout = decorated_function.cache_timeout
+                    if timeout is None:
+                        timeout = current_app.config['CACHE_DEFAULT_TIMEOUT']
+                    now = time.time()
+                    entry = {'value': rv, 'fresh_until': now + timeout if timeout > 0 else 0}
+                    if isinstance(rv, (str, bytes)):  # views returning a page body
+                        body = rv.encode('utf-8') if isinstance(rv, str) else rv
+                        entry.update(etag=hashlib.md5(body).hexdigest(), last_modified=now)
+                        method = current_app.config['CACHE_COMPRESSION'] if compression is None else compression
+                        if method and len(body) >= current_app.config['CACHE_COMPRESSION_THRESHOLD']:
+                            self._compress(entry, body, method)
+                    if stale_ttl and timeout > 0:
+                        timeout += stale_ttl  # keep the stale copy around to serve during the refresh
+                    try:
+                        self.cache.set(cache_key, entry, timeout=timeout)
+                        self.stats.stored(label, entry)
+                    except Exception:
+                        if current_app.debug:
+                            raise
+                        logger.exception('Exception possibly due to cache backend.')
+                    return entry
+
+                if entry is None:
+                    self.stats.miss(label)
+                    if single_flight and not forced:
+                        entry = self._coalesce(cache_key, compute)
+                    else:
+                        entry = compute()
+                else:
+                    self.stats.hit(label)
+                if stale_ttl and entry['fresh_until'] and entry['fresh_until'] < time.time():
+                    self._refresh_in_background(cache_key, compute)
+                if has_request_context() and current_app.view_functions.get(request.endpoint) is decorated_function:
+                    return self._view_response(entry)
+                return self._decompress(entry)
+
+            decorated_function.uncached = f
+            decorated_function.cache_timeout = timeout
+            decorated_function.tags = tags
+
+            def make_cache_key(*args, **kwargs):
+                cache_key = self._view_key(key_prefix, query_string)
+                if tags:
+                    cache_key += '#' + self._tag_versions(tags)
+                return cache_key
+
+            decorated_function.make_cache_key = make_cache_key
+            return decorated_function
+        return decorator
+
+    def memoize(self, timeout=None, make_name=None, unless=None, forced_update=None, single_flight=False,
+                tags=(), local_ttl=None):
+        """Flask-Caching's memoize, with the ``single_flight`` and ``tags`` options of :meth:`cached`.
+
+        With ``local_ttl``, results are also kept that many seconds in a dict
+        of the process, checked before the cache backend, so repeated calls
+        with the same arguments skip the backend round trip. Deleting or
+        invalidating the function clears the dict of the current process; the
+        other processes may return the old result until their copy expires,
+        so keep ``local_ttl`` short. Statistics are recorded under the
+        function's name.
+        """
+        if tags:
+            # the name goes into the hashed key, so appending the tag generations
+            # to it moves every call of the function to new keys when a tag is invalidated
+            base_make_name = make_name
+
+            def make_name(fname):
+                fname = base_make_name(fname) if callable(base_make_name) else fname
+                return '%s#%s' % (fname, self._tag_versions(tags))
+
+        def decorator(f):
+            # same flow as Flask-Caching's memoize, with single flight and statistics
+            label = function_namespace(f)[0]
+            local_cache = {}  # typed (args, kwargs) -> (expires, value); dict operations are atomic, no lock needed
+            if local_ttl:
+                self._local_caches.append((tags, local_cache))
+
+            def remember(local_key, rv):
+                ttl = local_ttl
+                if decorated_function.cache_timeout:
+                    ttl = min(ttl, decorated_function.cache_timeout)
+                if len(local_cache) >= current_app.config['CACHE_LOCAL_MAX_ENTRIES']:
+                    try:  # drop the oldest entry, dicts keep the insertion order
+                        local_cache.pop(next(iter(local_cache)), None)
+                    except (StopIteration, RuntimeError):  # emptied or changed by another thread
+                        pass
+                local_cache[local_key] = (time.time() + ttl, rv)
+                return rv
+
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                if self._bypass_cache(unless, f, *args, **kwargs):
+                    return f(*args, **kwargs)
+                forced = callable(forced_update) and forced_update() is True
+                local_key = None
+                if local_ttl:
+                    local_key = _typed((args, tuple(sorted(kwargs.items())))) if kwargs else _typed(args)
+                    try:
+                        local_entry = local_cache.get(local_key)
+                    except TypeError:  # unhashable arguments, only the backend can cache them
+                        local_key = local_entry = None
+                    if local_entry is not None and not forced and local_entry[0] > time.time():
+                        self.stats.hit(label, local=True)
+                        return local_entry[1]
+                try:
+                    cache_key = decorated_function.make_cache_key(f, *args, **kwargs)
+                    rv = None if forced else self.cache.get(cache_key)
+                except Exception:
+                    if current_app.debug:
+                        raise
+                    logger.exception('Exception possibly due to cache backend.')
+                    return f(*args, **kwargs)
+                if rv is not None:
+                    self.stats.hit(label)
+                    return rv if local_key is None else remember(local_key, rv)
+                self.stats.miss(label)
+
+                def compute():
+                    start = time.time()
+                    rv = f(*args, **kwargs)
+                    self.stats.computed(label, time.time() - start)
+                    try:
+                        self.cache.set(cache_key, rv, timeout=decorated_function.cache_timeout)
+                        self.stats.stored(label, rv)
+                    except Exception:
+                        if current_app.debug:
+                            raise
+                        logger.exception('Exception possibly due to cache backend.')
+                    return rv
+
+                if single_flight and not forced:
+                    rv = self._coalesce(cache_key, compute)
+                else:
+                    rv = compute()
+                return rv if local_key is None else remember(local_key, rv)
+
+            decorated_function.uncached = f
+            decorated_function.cache_timeout = timeout
+            decorated_function.make_cache_key = self._memoize_make_cache_key(
+                make_name=make_name, timeout=decorated_function, forced_update=forced_update)
+            decorated_function.delete_memoized = lambda: self.delete_memoized(decorated_function)
+            decorated_function.local_cache = local_cache
+            return decorated_function
+        return decorator
@@ -5,13 +5,30 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import functools
+import json
 import os
+import re
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 
 import click
 from flask import Flask
-from flask import redirect, url_for, abort, render_template, flash
-from flask_sqlalchemy import SQLAlchemy
+from flask import redirect, url_for, abort, render_template, flash, request, Response, stream_with_context
+from flask import g, jsonify, has_request_context, get_flashed_messages
+from flask_caching import Cache
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy
+from sqlalchemy import DDL, bindparam, create_engine, func, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import joinedload, selectinload
 from flask_wtf import FlaskForm
 from wtforms import SubmitField, TextAreaField
 from wtforms.validators import DataRequired
@@ -40,7 +57,96 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', prefix + os.pa
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # 是否追踪对象的修改 设为 False 关闭警告
 
+# 主页每页显示的笔记数量，可通过查询参数 ?limit= 调整，但不会超过 NOTES_MAX_PER_PAGE
+app.config['NOTES_PER_PAGE'] = int(os.getenv('NOTES_PER_PAGE', 20))
+app.config['NOTES_MAX_PER_PAGE'] = 100
+
+# N+1 查询检测，默认仅在调试模式下开启；单个请求执行的SQL语句超过阈值时记录警告
+app.config['DETECT_N_PLUS_ONE'] = app.debug
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.getenv('N_PLUS_ONE_THRESHOLD', 10))
+
+app.config['SEARCH_RESULTS_PER_PAGE'] = 20
+
+# 模型对象缓存 开启后按主键读取笔记时先查缓存，缓存后端的配置方式与 cache 示例程序相同
+# 默认关闭：simple 缓存保存在每个进程内，多进程部署时其他进程的缓存不会失效，会读到旧数据，
+# 开启时应把 CACHE_TYPE 设为 redis 等多个进程共享的缓存后端
+app.config['MODEL_CACHE'] = os.getenv('MODEL_CACHE', '0').lower() in ('1', 'true', 'yes')
+app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'simple')
+app.config['CACHE_DEFAULT_TIMEOUT'] = 5 * 60
+
+# 数据库引擎与连接池配置 均可通过环境变量设置，使用 Flask-SQLAlchemy 自带的配置键
+# SQLALCHEMY_POOL_SIZE 连接池保持的连接数；SQLALCHEMY_MAX_OVERFLOW 连接池满时最多额外创建的连接数；
+# SQLALCHEMY_POOL_RECYCLE 连接被回收重建前的最长存活秒数，未设置时使用驱动的默认值（MySQL为7200秒）；
+# SQLALCHEMY_POOL_PRE_PING 每次从连接池取出连接时先测试连接是否可用
+app.config['SQLALCHEMY_POOL_SIZE'] = int(os.getenv('SQLALCHEMY_POOL_SIZE', 5))
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = int(os.getenv('SQLALCHEMY_MAX_OVERFLOW', 10))
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = int(os.getenv('SQLALCHEMY_POOL_TIMEOUT', 30))
+if os.getenv('SQLALCHEMY_POOL_RECYCLE'):
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = int(os.getenv('SQLALCHEMY_POOL_RECYCLE'))
+app.config['SQLALCHEMY_POOL_PRE_PING'] = os.getenv('SQLALCHEMY_POOL_PRE_PING', '0').lower() in ('1', 'true', 'yes')
+# SQLite 专用设置：WAL日志模式让读写互不阻塞；写入者之间仍然互斥，
+# 遇到锁时最多等待 SQLITE_BUSY_TIMEOUT 毫秒，而不是直接抛出 database is locked 错误。
+# WAL模式会保存在数据库文件中，并在旁边创建 -wal 和 -shm 文件，所以默认关闭，不改动随附的 data.db
+app.config['SQLITE_WAL'] = os.getenv('SQLITE_WAL', '0').lower() in ('1', 'true', 'yes')
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+
+def engine_options(config, url):    # 根据配置生成传给 create_engine() 的参数
+    options = {'pool_pre_ping': config['SQLALCHEMY_POOL_PRE_PING']}
+    if url.drivername.startswith('sqlite'):
+        if url.database in (None, '', ':memory:'):
+            return options  # 内存数据库只能使用单个连接（StaticPool），不设置连接池大小
+        # SQLite 文件数据库默认使用 NullPool，每次请求都要重新打开数据库文件；
+        # 改为 QueuePool 复用连接，此时连接会在不同线程间传递，需要关闭 check_same_thread 检查
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {'check_same_thread': False,
+                                   'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000.0}
+    for key, name in (('pool_size', 'SQLALCHEMY_POOL_SIZE'), ('max_overflow', 'SQLALCHEMY_MAX_OVERFLOW'),
+                      ('pool_timeout', 'SQLALCHEMY_POOL_TIMEOUT'), ('pool_recycle', 'SQLALCHEMY_POOL_RECYCLE')):
+        if config.get(name) is not None:
+            options[key] = config[name]
+    return options
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record, wal=None):   # 每个新建立的SQLite连接都执行一次
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')    # 开启外键约束，ON DELETE CASCADE 才会生效
+    if app.config['SQLITE_WAL'] if wal is None else wal:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')     # WAL模式下 NORMAL 已能保证数据库不会损坏
+    cursor.execute('PRAGMA busy_timeout=%d' % app.config['SQLITE_BUSY_TIMEOUT'])
+    cursor.execute('PRAGMA mmap_size=%d' % app.config['SQLITE_MMAP_SIZE'])
+    cursor.close()
+
+
+# Flask-SQLAlchemy 创建引擎时会调用 apply_driver_hacks() 调整引擎参数，
+# 继承 SQLAlchemy 类并重写这个方法即可加入自定义的连接池参数
+class SQLAlchemy(_SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        rv = super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        # 内存数据库已被设为 StaticPool，SQLALCHEMY_POOL_SIZE 为0时已被设为 NullPool，都不需要连接池参数；
+        # 其他情况只补充缺少的参数，不覆盖 Flask-SQLAlchemy 根据配置和驱动设置的值（如MySQL的 pool_recycle）
+        if 'poolclass' not in options:
+            tuned = engine_options(app.config, info)
+            connect_args = options.setdefault('connect_args', {})
+            for key, value in tuned.pop('connect_args', {}).items():
+                connect_args.setdefault(key, value)
+            for key, value in tuned.items():
+                options.setdefault(key, value)
+        return rv
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if not self.event.contains(engine, 'connect', set_sqlite_pragma):
+            self.event.listen(engine, 'connect', set_sqlite_pragma)
+        return engine
+
+
 db = SQLAlchemy(app)    # 实例化 SQLAlchemy类
+cache = Cache(app)
 # 迁移数据库
 # migrate = Migrate(app, db)  # 在db对象创建后调用
 
@@ -71,11 +177,77 @@ def initdb(drop):
     db.create_all()     # 建库和建表  调用create_all() 方法    生成data.db文件
     click.echo('Initialized database.')
 
+
 # 模型类（表）不是一成不变的，当你添加了新的模型类，或是在模型类中添加了新的字段，甚至是修改了字段的名称或类型，都需要更新表。
 # 数据库表并不会随着模型的修改而自动更新
 # 不在意数据，最简单方法：先删除 再创建
 
 
+# 命令组 app.cli.group() 创建的命令通过 flask notes <子命令> 调用
+@app.cli.group()
+def notes():
+    """Import and export notes."""
+
+
+def _chunked(iterable, size):   # 把可迭代对象按 size 切分成多个列表
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# 逐条 db.session.add() 再 commit() 时，每一行都要经过ORM的工作单元并单独提交一次事务；
+# 这里每批只提交一次，并使用Core的insert() 语句传入字典列表，由DBAPI的 executemany() 批量执行。
+@notes.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--batch-size', default=5000, help='Rows inserted per transaction.')
+def import_notes(file, batch_size):
+    """Import notes from a JSON Lines file ({"body": ...} per line)."""
+    skipped = []
+
+    def read_rows():    # 跳过格式错误的行并报告行号，不中断导入
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield {'body': json.loads(line)['body']}
+            except (ValueError, KeyError, TypeError) as e:    # JSON格式错误、缺少 body、不是对象
+                skipped.append(number)
+                click.echo('Skipped line %d: %s: %s' % (number, type(e).__name__, e), err=True)
+
+    total = 0
+    start = time.time()
+    for chunk in _chunked(read_rows(), batch_size):
+        db.session.execute(Note.__table__.insert(), chunk)
+        db.session.commit()
+        total += len(chunk)
+        click.echo('Imported %d notes...' % total, err=True)
+    elapsed = time.time() - start
+    click.echo('Imported %d notes in %.2fs (%.0f rows/sec), skipped %d malformed lines.'
+               % (total, elapsed, total / elapsed if elapsed else total, len(skipped)))
+
+
+@notes.command('export')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-',
+              help='Output file, default to stdout.')
+@click.option('--batch-size', default=5000, help='Rows fetched from the cursor at a time.')
+def export_notes(output, batch_size):
+    """Export notes as JSON Lines."""
+    total = 0
+    start = time.time()
+    # 只查询需要的列，yield_per() 分批从游标读取，导出时内存占用与表的大小无关
+    for note_id, body in db.session.query(Note.id, Note.body).order_by(Note.id).yield_per(batch_size):
+        output.write(json.dumps({'id': note_id, 'body': body}, ensure_ascii=False) + '\n')
+        total += 1
+    elapsed = time.time() - start
+    click.echo('Exported %d notes in %.2fs (%.0f rows/sec).'
+               % (total, elapsed, total / elapsed if elapsed else total), err=True)
+
+
 # Forms
 class NewNoteForm(FlaskForm):   # 填写新笔记的表单
     body = TextAreaField('Body', validators=[DataRequired()])
@@ -109,11 +281,114 @@ class Note(db.Model):   # 定义 Note 模型类    继承 db.Model 基类
         # %r是一个万能的格式符，它会将后面给的参数原样打印出来，带有类型信息
 
 
+# read-through cache 读穿透缓存
+# 先从缓存中读取对象，未命中时再查询数据库，并把结果存入缓存
+def model_cache_key(model, pk):
+    return 'model/%s/%s' % (model.__tablename__, pk)
+
+
+def get_cached(model, pk):
+    if not app.config['MODEL_CACHE']:
+        return model.query.get(pk)
+    key = model_cache_key(model, pk)
+    obj = cache.get(key)
+    if obj is not None:
+        # 缓存中取出的是与会话无关的对象副本，merge(load=False) 把它加入当前会话而不查询数据库，
+        # 之后就可以像查询得到的对象一样修改或删除它
+        return db.session.merge(obj, load=False)
+    obj = model.query.get(pk)
+    if obj is not None:
+        cache.set(key, obj)
+    return obj
+
+
+# 对象被更新或删除后，mapper 级别的 after_update、after_delete 事件会被触发，
+# 但这两个事件在 flush 时触发，此时事务还没有提交：如果这时就删除缓存，其他线程仍然会读到提交前的旧记录，
+# 并把它重新存入缓存。所以先把键记录在会话的 info 字典中，提交之后再删除，回滚时丢弃
+# 注意：Query.update()、Query.delete() 这类批量操作不会触发这两个事件
+def invalidate_cached_model(mapper, connection, target):
+    session = inspect(target).session
+    key = model_cache_key(type(target), mapper.primary_key_from_instance(target)[0])
+    session.info.setdefault('invalidated_cache_keys', set()).add(key)
+
+
+def delete_invalidated_cache_keys(session):
+    keys = session.info.pop('invalidated_cache_keys', None)
+    if keys:
+        cache.delete_many(*keys)
+
+
+def discard_invalidated_cache_keys(session):
+    session.info.pop('invalidated_cache_keys', None)
+
+
+for cached_model in (Note,):
+    db.event.listen(cached_model, 'after_update', invalidate_cached_model)
+    db.event.listen(cached_model, 'after_delete', invalidate_cached_model)
+db.event.listen(db.session, 'after_commit', delete_invalidated_cache_keys)
+db.event.listen(db.session, 'after_rollback', discard_invalidated_cache_keys)
+
+
+# keyset (seek) pagination 键集分页
+# OFFSET 分页需要数据库先扫描并丢弃前面所有的记录，页码越大越慢；
+# 键集分页记住上一页最后一条记录的主键，下一页直接 WHERE id > :after，
+# 借助主键索引定位，无论表有多大，每一页的查询耗时都基本不变。
+def paginate_notes(after=None, before=None, limit=20):
+    query = Note.query
+    if before is not None:  # 上一页：倒序取 before 之前的 limit 条，再翻转回正序
+        notes = query.filter(Note.id < before).order_by(Note.id.desc()).limit(limit + 1).all()
+        if len(notes) < limit:  # 已接近开头，不足一页时改为返回完整的第一页
+            return paginate_notes(limit=limit)
+        has_prev = len(notes) > limit   # 多取一条，用来判断是否还有上一页
+        notes = notes[:limit][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(Note.id > after)
+        notes = query.order_by(Note.id).limit(limit + 1).all()
+        has_next = len(notes) > limit
+        notes = notes[:limit]
+        has_prev = after is not None
+    next_cursor = notes[-1].id if notes and has_next else None
+    prev_cursor = notes[0].id if notes and has_prev else None
+    return notes, prev_cursor, next_cursor
+
+
 @app.route('/')
 def index():    # 渲染主页对应的模板
     form = DeleteNoteForm()     # 由于删除按钮需要在主页笔记下添加
-    notes = Note.query.all()    # 这是为了在主页中列出所有保存的笔记
-    return render_template('index.html', notes=notes, form=form)    # 渲染模板 p78
+    # ?after=<id> 下一页，?before=<id> 上一页，?limit= 每页数量
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', app.config['NOTES_PER_PAGE'], type=int)
+    limit = max(1, min(limit, app.config['NOTES_MAX_PER_PAGE']))
+    notes, prev_cursor, next_cursor = paginate_notes(after, before, limit)
+    # 不再一次性查询所有笔记 Note.query.all()，只查询当前页
+    return render_template('index.html', notes=notes, form=form, limit=limit,
+                           prev_cursor=prev_cursor, next_cursor=next_cursor)    # 渲染模板 p78
+
+
+# streaming 流式渲染
+# render_template() 会先把整个页面渲染成一个字符串再返回，笔记很多时首字节时间（TTFB）和内存占用都随之增长。
+# Template.generate() 返回一个生成器，每渲染出一段就产出一段，
+# 配合 stream_with_context() 在生成器运行期间保持请求上下文，就可以边查询、边渲染、边发送。
+def stream_template(template_name, **context):
+    app.update_template_context(context)    # 注入 url_for、get_flashed_messages 等模板上下文
+    # 响应开始发送前会话cookie就已经保存，模板渲染时才取出闪现消息的话，消息不会从会话中删除，
+    # 下一个页面会再次显示；在这里先取出，消息缓存在请求上下文中，模板中调用 get_flashed_messages() 得到同样的结果
+    get_flashed_messages()
+    template = app.jinja_env.get_template(template_name)
+    rv = template.stream(context)   # TemplateStream 包装了 Template.generate()
+    rv.enable_buffering(5)  # 每 5 段合并发送一次，避免产生大量很小的数据块
+    return rv
+
+
+@app.route('/notes/stream')
+def stream_notes():     # 以流式响应输出全部笔记
+    form = DeleteNoteForm()
+    # yield_per() 让查询每次只从游标取出 100 行并转换为对象，而不是一次性加载全部结果
+    notes = Note.query.order_by(Note.id).yield_per(100)
+    return Response(stream_with_context(stream_template('all_notes.html', notes=notes, form=form)))
 
 
 # CRUD Create,创建  Read,查询  Update,更新  Delete,删除
@@ -146,7 +421,9 @@ def new_note():     # 渲染创建笔记的模板、处理表单的提交
 @app.route('/edit/<int:note_id>', methods=['GET', 'POST'])  # int 变量转换器 p36
 def edit_note(note_id):     # 被修改笔记的主键值 id字段
     form = EditNoteForm()
-    note = Note.query.get(note_id)  # get获取对应实例
+    note = get_cached(Note, note_id)  # 相当于 Note.query.get(note_id)，get获取对应实例
+    if note is None:
+        abort(404)
     if form.validate_on_submit():
         note.body = form.body.data
         db.session.commit()
@@ -163,7 +440,9 @@ def delete_note(note_id):
     # 删除操作不能通过GET请求 p155
     form = DeleteNoteForm()
     if form.validate_on_submit():   # 唯一需要被验证的是CSRF令牌
-        note = Note.query.get(note_id)
+        note = get_cached(Note, note_id)
+        if note is None:
+            abort(404)
         db.session.delete(note)     # 删除
         db.session.commit()     # 提交数据库会话
         flash('Your note is deleted.')
@@ -421,7 +700,8 @@ class Post(db.Model):   # 帖子
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(50))
     body = db.Column(db.Text)
-    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')  # collection
+    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan',
+                               passive_deletes=True)  # collection
     # 级联行为通过关系函数relationship()的cascade参数设置
     # 在操作Post对象时，处于附属地位的Comment对象也被相应执行某些操作，
     # 应该在Post类的关系函数中定义级联参数
@@ -434,15 +714,34 @@ class Post(db.Model):   # 帖子
     # delete-orphan: 包含delete级联的行为，除此之外，
     #                当某个Post对象(父对象)与某个Comment对象(子对象)解除关系时，
     #                也会删除该Comment对象，这个解除关系的对象被称为孤立对象(orphan object)
+    # passive_deletes=True: 删除Post时不再把所有未加载的Comment加载到会话中逐条删除，
+    #                       而是交给数据库外键的 ON DELETE CASCADE 一次性删除，
+    #                       已经加载到会话中的Comment仍然会由ORM删除
 
 
 class Comment(db.Model):    # 评论
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), index=True)
+    # ondelete='CASCADE' 在建表语句中生成 ON DELETE CASCADE，父记录被删除时数据库自动删除子记录
+    # SQLite 需要执行 PRAGMA foreign_keys=ON 才会检查外键；已有的表需要重新创建（flask initdb --drop），
+    # 或者执行迁移 migrations/versions/4cc2a2564792_comment_post_id_cascade.py（随附的 data.db 已经迁移）：
+    # 先取消本文件开头 from flask_migrate import Migrate 和 migrate = Migrate(app, db) 两行的注释，再执行 flask db upgrade
+    # 在 post_id 上建立索引，数据库级联删除时可以直接定位评论，不必全表扫描
     post = db.relationship('Post', back_populates='comments')  # scalar
 
 
+# 批量删除帖子 只执行一条 DELETE FROM post WHERE id IN (...) 语句，
+# 评论由数据库级联删除，不会把任何对象加载到会话中
+def delete_posts(post_ids, batch_size=500):
+    post_ids = list(post_ids)
+    count = 0
+    for i in range(0, len(post_ids), batch_size):   # SQLite 单条语句最多支持999个参数
+        count += Post.query.filter(Post.id.in_(post_ids[i:i + batch_size])).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
 # event listening 事件监听
 # 通过注册事件监听函数，实现在body列修改时，自动叠加表示被修改次数的edit_time字段。
 class Draft(db.Model):  # 草稿
@@ -490,4 +789,327 @@ def increment_edit_time(target, value, oldvalue, initiator):
 >>> draft.edit_time
 3 
 >>> db.session.commit()
-'''
\ No newline at end of file
+'''
+
+
+# atomic update 原子更新
+# 上面的监听函数需要先把Draft记录加载到Python中，在Python里加1后再写回数据库；
+# 两个请求同时编辑同一篇草稿时，它们读到的是同一个旧值，后提交的会覆盖先提交的结果，导致丢失一次计数。
+# 直接执行 UPDATE draft SET body=:body, edit_time=edit_time+1 WHERE id=:id，
+# 由数据库在一条语句中完成读取和加1，既不需要先加载对象，也不会丢失更新。
+# 注意：这样的批量更新语句不会触发 set 事件，也不会更新会话中已加载的对象
+def update_draft(draft_id, body):
+    table = Draft.__table__
+    statement = table.update().where(table.c.id == draft_id).values(
+        body=body, edit_time=func.coalesce(table.c.edit_time, 0) + 1)
+    result = db.session.execute(statement)
+    db.session.commit()
+    return result.rowcount == 1     # 返回是否找到对应的草稿
+
+
+def update_drafts(bodies):  # 批量更新 bodies 为 {草稿id: 新正文} 字典
+    table = Draft.__table__
+    # bindparam() 定义参数占位符，同一条语句配合参数字典列表使用 executemany() 执行
+    statement = table.update().where(table.c.id == bindparam('draft_id')).values(
+        body=bindparam('new_body'), edit_time=func.coalesce(table.c.edit_time, 0) + 1)
+    db.session.execute(statement, [{'draft_id': draft_id, 'new_body': body}
+                                   for draft_id, body in bodies.items()])
+    db.session.commit()
+
+
+# eager loading 预加载
+# 关系属性默认使用延迟加载（lazy='select'），列出10个作者及其文章时，
+# 会先执行1条查询获取作者，再为每个作者各执行1条查询获取文章，即 N+1 查询问题。
+# 在查询中使用 options() 指定加载策略，可以一次性加载关系另一侧的记录：
+# selectinload() 额外执行一条 SELECT ... WHERE author_id IN (...) 查询，适合集合关系属性；
+# joinedload() 使用 LEFT OUTER JOIN 在同一条查询中加载，适合标量关系属性或数据较少的集合。
+loader_strategies = {
+    'select': selectinload,
+    'joined': joinedload,
+    'lazy': None,   # 保持默认的延迟加载，用于对比
+}
+
+# 资源名: (模型类, 关系属性名, 关系另一侧要输出的字段名)
+relationship_listings = {
+    'authors': (Author, 'articles', 'title'),
+    'writers': (Writer, 'books', 'name'),
+    'singers': (Singer, 'songs', 'name'),
+    'students': (Student, 'teachers', 'name'),
+    'posts': (Post, 'comments', 'body'),
+}
+
+
+# ?load=select|joined|lazy 为每个请求选择加载策略，?limit= 控制返回的记录数量
+@app.route('/api/<any(authors, writers, singers, students, posts):resource>')
+def list_with_relationship(resource):
+    model, attr, field = relationship_listings[resource]
+    strategy = request.args.get('load', 'select')
+    if strategy not in loader_strategies:
+        abort(400)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    query = model.query.order_by(model.id).limit(limit)
+    loader = loader_strategies[strategy]
+    if loader is not None:
+        query = query.options(loader(getattr(model, attr)))
+    items = [dict(id=item.id,
+                  name=getattr(item, 'name', None) or getattr(item, 'title', None),
+                  **{attr: [dict(id=child.id, **{field: getattr(child, field)}) for child in getattr(item, attr)]})
+             for item in query]
+    return jsonify({resource: items, 'load': strategy})
+
+
+# N+1 detection N+1 查询检测
+# before_cursor_execute 事件在每条SQL语句发送给数据库前触发，监听Engine类即对所有引擎生效
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and app.config['DETECT_N_PLUS_ONE']:
+        g.setdefault('sql_statements', []).append(statement)
+
+
+def guess_relationships(statement):
+    # 延迟加载的SQL形如 SELECT ... FROM article WHERE ? = article.author_id
+    # 根据FROM子句中的表和WHERE子句中的外键列，找出可能触发这条语句的关系属性
+    match = re.search(r'\bFROM\s+(.+?)(?:\s+WHERE\b|$)', statement, re.S)
+    tables = set(name.strip().split()[0] for name in match.group(1).split(',')) if match else set()
+    candidates = []
+    for model in db.Model.__subclasses__():
+        for rel in inspect(model).relationships:
+            expected = {rel.target.name}
+            if rel.secondary is not None:
+                expected.add(rel.secondary.name)
+            if expected != tables:
+                continue
+            remote_columns = ['%s.%s' % (remote.table.name, remote.name) for _, remote in rel.local_remote_pairs]
+            if all(column in statement for column in remote_columns):
+                candidates.append('%s.%s' % (model.__name__, rel.key))
+    return candidates
+
+
+@app.after_request
+def detect_n_plus_one(response):
+    statements = g.get('sql_statements')
+    if statements and len(statements) > app.config['N_PLUS_ONE_THRESHOLD']:
+        statement, count = Counter(statements).most_common(1)[0]
+        app.logger.warning('Possible N+1 queries on %s %s: %d SQL statements executed, '
+                           'the same statement repeated %d times (relationship: %s): %s',
+                           request.method, request.path, len(statements), count,
+                           ', '.join(guess_relationships(statement)) or 'unknown', statement)
+    return response
+
+
+# full-text search 全文搜索
+# Note.body 和 Article.body 没有索引，LIKE '%foo%' 查询只能逐行扫描整张表。
+# SQLite 的 FTS5 扩展提供倒排索引，这里为每个表创建一个外部内容（external content）虚拟表，
+# 虚拟表只保存索引，原文仍然保存在原表中，通过触发器在插入、更新、删除时同步索引。
+fts_columns = {
+    'note': ('body',),
+    'article': ('title', 'body'),
+}
+
+
+def fts_statements(table):   # 生成创建虚拟表和同步触发器的SQL语句
+    columns = fts_columns[table]
+    names = dict(fts='%s_fts' % table, table=table, columns=', '.join(columns),
+                 new=', '.join('new.%s' % column for column in columns),
+                 old=', '.join('old.%s' % column for column in columns))
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, content='{table}', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+        "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+        "CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+        "CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+        "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+    ]
+    return [statement.format(**names) for statement in statements]
+
+
+# create_all() 创建表后触发 after_create 事件，drop_all() 删除表前触发 before_drop 事件
+# execute_if(dialect='sqlite') 使这些语句只在SQLite数据库上执行
+for table in fts_columns:
+    for statement in fts_statements(table):
+        db.event.listen(db.metadata.tables[table], 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    db.event.listen(db.metadata.tables[table], 'before_drop',
+                    DDL('DROP TABLE IF EXISTS %s_fts' % table).execute_if(dialect='sqlite'))
+
+
+@app.cli.command()
+def reindex():
+    """Create missing full-text indexes and rebuild them from the tables."""
+    for table in fts_columns:
+        for statement in fts_statements(table):
+            db.session.execute(statement)
+        # 'rebuild' 命令根据原表内容重新生成整个索引，用于为已有数据建立索引
+        db.session.execute("INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(table))
+    db.session.commit()
+    click.echo('Rebuilt full-text indexes.')
+
+
+def fts_query(keywords):
+    # 把每个关键词用双引号包裹为短语，避免用户输入的 AND、*、: 等字符被解析为FTS5查询语法
+    return ' '.join('"%s"' % word.replace('"', '""') for word in keywords.split())
+
+
+def full_text_search(model, keywords, limit, offset=0):
+    # rank 列即 bm25() 相关度得分，值越小越相关；先在索引中取出这一页的id，再按id查询完整记录
+    statement = text('SELECT rowid FROM {0}_fts WHERE {0}_fts MATCH :query '
+                     'ORDER BY rank LIMIT :limit OFFSET :offset'.format(model.__tablename__))
+    ids = [row[0] for row in db.session.execute(statement, {'query': fts_query(keywords),
+                                                            'limit': limit, 'offset': offset})]
+    records = {record.id: record for record in model.query.filter(model.id.in_(ids))} if ids else {}
+    return [records[record_id] for record_id in ids if record_id in records]
+
+
+@app.route('/search')
+def search():
+    keywords = request.args.get('q', '').strip()
+    category = request.args.get('category', 'note')
+    if category not in fts_columns:
+        abort(400)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+    results = []
+    has_next = False
+    if keywords:
+        model = Note if category == 'note' else Article
+        try:
+            results = full_text_search(model, keywords, per_page + 1, (page - 1) * per_page)
+        except OperationalError as e:
+            if 'no such table' not in str(e.orig):
+                raise
+            # 在加入全文搜索之前创建的数据库（如随附的 data.db）还没有索引表
+            db.session.rollback()
+            flash('The full-text index is missing, run "flask reindex" to create it.')
+        has_next = len(results) > per_page  # 多取一条，判断是否有下一页
+        results = results[:per_page]
+    return render_template('search.html', keywords=keywords, category=category, results=results,
+                           page=page, has_next=has_next)
+
+
+# benchmark 性能测试命令
+@app.cli.group()
+def bench():
+    """Run database benchmarks."""
+
+
+@contextmanager
+def _temporary_database():  # 在临时数据库文件中建表，期间 db.session 都使用这个数据库，不影响 data.db
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    try:
+        db.create_all()     # 连接地址改变后 Flask-SQLAlchemy 会创建新的引擎
+        yield
+    finally:
+        db.session.remove()
+        db.get_engine().dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+
+
+def _run_concurrently(threads, target):    # 启动多个线程执行 target(i)，返回耗时
+    workers = [threading.Thread(target=target, args=[i]) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+
+@bench.command('writes')
+@click.option('--threads', default=8, help='Number of concurrent writers.')
+@click.option('--rows', default=500, help='Rows inserted by each writer, one transaction per row.')
+def bench_writes(threads, rows):
+    """Compare concurrent write throughput before and after SQLite tuning."""
+    # 使用临时数据库文件，不影响 data.db
+    for label, tuned in (('default engine', False), ('tuned engine', True)):
+        path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        url = prefix + path
+        if tuned:
+            engine = create_engine(url, **engine_options(app.config, make_url(url)))
+            # 临时数据库可以直接开启WAL，不受 SQLITE_WAL 配置影响
+            db.event.listen(engine, 'connect', functools.partial(set_sqlite_pragma, wal=True))
+        else:   # 默认参数：NullPool、回滚日志（DELETE）模式
+            engine = create_engine(url)
+        db.Model.metadata.create_all(engine, tables=[Note.__table__])
+        locked = []     # list.append() 是线程安全的
+
+        def write(i):
+            for n in range(rows):
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(Note.__table__.insert(), body='writer %d row %d' % (i, n))
+                except OperationalError:    # database is locked
+                    locked.append(n)
+
+        elapsed = _run_concurrently(threads, write)
+        engine.dispose()
+        written = threads * rows - len(locked)
+        click.echo('%s: %d rows in %.2fs (%.0f rows/sec), %d failed with "database is locked"'
+                   % (label, written, elapsed, written / elapsed, len(locked)))
+
+
+@bench.command('drafts')
+@click.option('--threads', default=8, help='Number of concurrent editors.')
+@click.option('--updates', default=100, help='Edits made by each editor.')
+def bench_drafts(threads, updates):
+    """Check edit_time for lost updates under concurrent editors."""
+    def edit_with_listener(draft_id, body):     # 加载对象后赋值，由 set 事件监听函数在Python中加1
+        draft = Draft.query.get(draft_id)
+        draft.body = body
+        db.session.commit()
+
+    with _temporary_database():
+        for label, edit in (('ORM set listener', edit_with_listener), ('atomic UPDATE', update_draft)):
+            draft = Draft(body='init')
+            db.session.add(draft)
+            db.session.commit()
+            draft_id = draft.id
+            errors = []
+
+            def editor(i):
+                with app.app_context():     # 每个线程使用自己的程序上下文和数据库会话
+                    for n in range(updates):
+                        try:
+                            edit(draft_id, 'editor %d edit %d' % (i, n))
+                        except OperationalError:
+                            db.session.rollback()
+                            errors.append(n)
+
+            elapsed = _run_concurrently(threads, editor)
+            expected = threads * updates - len(errors)
+            db.session.expire_all()
+            edit_time = Draft.query.get(draft_id).edit_time
+            click.echo('%s: %d edits in %.2fs, edit_time=%d, lost updates=%d'
+                       % (label, expected, elapsed, edit_time, expected - edit_time))
+
+
+@bench.command('cascade')
+@click.option('--comments', default=20000, help='Comments attached to the deleted post.')
+def bench_cascade(comments):
+    """Compare ORM cascade delete with the bulk delete of a post."""
+    def create_post():
+        post = Post(title='bench')
+        db.session.add(post)
+        db.session.commit()
+        db.session.execute(Comment.__table__.insert(), [{'body': 'comment %d' % i, 'post_id': post.id}
+                                                        for i in range(comments)])
+        db.session.commit()
+        return post.id
+
+    def orm_cascade(post_id):   # 原来的方式：加载全部评论，逐条执行 DELETE
+        post = Post.query.get(post_id)
+        post.comments   # 加载集合后，ORM会为每条评论单独发出删除语句
+        db.session.delete(post)
+        db.session.commit()
+
+    with _temporary_database():
+        for label, delete in (('ORM cascade', orm_cascade), ('bulk delete', lambda post_id: delete_posts([post_id]))):
+            post_id = create_post()
+            db.session.expunge_all()
+            start = time.time()
+            delete(post_id)
+            elapsed = time.time() - start
+            remaining = Comment.query.filter_by(post_id=post_id).count()
+            click.echo('%s: deleted a post with %d comments in %.3fs (%d comments left)'
+                       % (label, comments, elapsed, remaining))
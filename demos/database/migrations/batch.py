@@ -0,0 +1,121 @@
+"""Helpers for data migrations on large tables.
+
+A single UPDATE over a big table holds its locks (and the whole rewritten
+row set in the transaction) until it commits. The helpers here walk the table
+in primary key order and commit after every batch on their own connection, so
+each lock is short-lived and memory stays bounded. Progress is recorded in the
+``data_migration_progress`` table, so an interrupted upgrade resumes after the
+last committed batch when it is run again.
+
+Keep data migrations in their own revision, separate from schema changes, and
+import the helpers from the revision script::
+
+    from migrations.batch import batch_update
+
+    def upgrade():
+        batch_update('lowercase_article_titles', 'article',
+                     {'title': sa.func.lower(sa.column('title'))})
+
+"""
+import logging
+import time
+
+import sqlalchemy as sa
+from alembic import op
+
+logger = logging.getLogger('alembic.env')
+
+PROGRESS_TABLE = 'data_migration_progress'
+
+
+def _progress_table(metadata):
+    return sa.Table(PROGRESS_TABLE, metadata,
+                    sa.Column('name', sa.String(128), primary_key=True),
+                    sa.Column('last_id', sa.Integer),
+                    sa.Column('done', sa.Boolean, nullable=False, default=False))
+
+
+def run_in_batches(name, table, process, batch_size=500, pk='id', columns=None, pause=0):
+    """Call ``process(connection, table, rows)`` for each batch of ``table``.
+
+    Every batch is selected with ``WHERE pk > :last_id ORDER BY pk LIMIT
+    :batch_size`` and processed in its own transaction, together with the
+    progress update, so a batch is either fully applied and recorded or not
+    at all. ``columns`` restricts the selected columns (the primary key is
+    always included); ``pause`` sleeps between batches to leave room for
+    other writers.
+    """
+    engine = op.get_bind().engine
+    metadata = sa.MetaData()
+    progress = _progress_table(metadata)
+    progress.create(engine, checkfirst=True)
+    target = sa.Table(table, metadata, autoload=True, autoload_with=engine)
+    key = target.c[pk]
+    if columns:
+        selected = [key] + [target.c[column] for column in columns if column != pk]
+    else:
+        selected = [target]
+
+    with engine.connect() as connection:
+        state = connection.execute(sa.select([progress]).where(progress.c.name == name)).first()
+        if state is not None and state.done:
+            logger.info('Data migration %s already completed, skipping.', name)
+            return
+        last_id = state.last_id if state is not None else None
+        if state is None:
+            connection.execute(progress.insert(), name=name, last_id=None, done=False)
+
+        remaining = sa.select([sa.func.count()]).select_from(target)
+        if last_id is not None:
+            remaining = remaining.where(key > last_id)
+            logger.info('Resuming data migration %s after %s=%s.', name, pk, last_id)
+        total = connection.execute(remaining).scalar()
+
+        processed = 0
+        start = time.time()
+        while True:
+            query = sa.select(selected).order_by(key).limit(batch_size)
+            if last_id is not None:
+                query = query.where(key > last_id)
+            with connection.begin():
+                rows = connection.execute(query).fetchall()
+                if rows:
+                    process(connection, target, rows)
+                    last_id = rows[-1][pk]
+                connection.execute(progress.update().where(progress.c.name == name),
+                                   last_id=last_id, done=not rows)
+            if not rows:
+                break
+            processed += len(rows)
+            elapsed = time.time() - start
+            logger.info('%s: %d/%d rows (%.0f rows/sec)', name, processed, total,
+                        processed / elapsed if elapsed else processed)
+            if pause:
+                time.sleep(pause)
+    logger.info('Data migration %s completed: %d rows in %.1fs.', name, processed, time.time() - start)
+
+
+def batch_update(name, table, values, where=None, **kwargs):
+    """Apply ``UPDATE table SET values`` batch by batch.
+
+    ``values`` maps column names to values or SQL expressions, ``where`` is
+    an optional callable receiving the reflected table and returning an extra
+    criterion. Other keyword arguments are passed to :func:`run_in_batches`.
+    """
+    pk = kwargs.get('pk', 'id')
+
+    def process(connection, target, rows):
+        statement = target.update().where(target.c[pk].in_([row[pk] for row in rows]))
+        if where is not None:
+            statement = statement.where(where(target))
+        connection.execute(statement.values(**values))
+
+    run_in_batches(name, table, process, columns=[pk], **kwargs)
+
+
+def reset_progress(name):
+    """Forget the recorded progress of ``name``, e.g. in ``downgrade()``."""
+    engine = op.get_bind().engine
+    progress = _progress_table(sa.MetaData())
+    if engine.has_table(PROGRESS_TABLE):
+        engine.execute(progress.delete().where(progress.c.name == name))
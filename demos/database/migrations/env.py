@@ -18,10 +18,24 @@ logger = logging.getLogger('alembic.env')
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from flask import current_app
+from migrations.batch import PROGRESS_TABLE
 config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Leave the tables not declared as models out of autogenerate."""
+    # the full-text indexes of the app are virtual tables created with raw DDL,
+    # with shadow tables such as note_fts_data; autogenerate would drop them
+    if type_ == 'table' and '_fts' in name:
+        return False
+    # bookkeeping of the batched data migrations, created on demand by batch.py
+    if type_ == 'table' and name == PROGRESS_TABLE:
+        return False
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -70,9 +84,14 @@ def run_migrations_online():
                                 poolclass=pool.NullPool)
 
     connection = engine.connect()
+    # commit after each revision instead of wrapping the whole upgrade in one
+    # transaction, so long data migrations (see batch.py) do not run behind
+    # an open transaction holding the locks taken by earlier revisions
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      transaction_per_migration=True,
+                      include_object=include_object,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
@@ -0,0 +1,35 @@
+"""delete comments with their post
+
+Revision ID: 4cc2a2564792
+Revises:
+Create Date: 2026-10-18 10:12:37.402315
+
+Flask-Migrate is disabled in app.py: uncomment the Migrate import and
+``migrate = Migrate(app, db)`` there before running ``flask db upgrade``.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4cc2a2564792'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# SQLite 不能修改已有的外键，batch_alter_table() 会按新的定义重建 comment 表并复制数据；
+# 原来的外键没有名称，通过命名约定为它命名后才能删除
+naming_convention = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+
+def upgrade():
+    with op.batch_alter_table('comment', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('fk_comment_post_id_post', type_='foreignkey')
+        batch_op.create_foreign_key('fk_comment_post_id_post', 'post', ['post_id'], ['id'], ondelete='CASCADE')
+        batch_op.create_index('ix_comment_post_id', ['post_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('comment', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_index('ix_comment_post_id')
+        batch_op.drop_constraint('fk_comment_post_id_post', type_='foreignkey')
+        batch_op.create_foreign_key('fk_comment_post_id_post', 'post', ['post_id'], ['id'])
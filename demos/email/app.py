@@ -5,16 +5,25 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import concurrent.futures
 import os
-from threading import Thread
+import socket
+import time
 
+import click
 import sendgrid
 from sendgrid.helpers.mail import Email as SGEmail, Content, Mail as SGMail
 from flask_mail import Mail, Message
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SubmitField
 from wtforms.validators import DataRequired, Email
-from flask import Flask, flash, redirect, url_for, render_template, request
+from flask import Flask, flash, redirect, url_for, render_template, request, jsonify
+
+from async_mail import AsyncMailer, aiohttp, aiosmtplib, api_payload
+from mail_queue import MailQueue
+from newsletter import read_recipients, send_newsletter
+from outbox import Outbox
+from smtp_pool import ConnectionPool
 
 app = Flask(__name__)
 app.jinja_env.trim_blocks = True
@@ -23,15 +32,29 @@ app.jinja_env.lstrip_blocks = True
 app.config.update(  # 加载配置
     SECRET_KEY=os.getenv('SECRET_KEY', 'secret string'),
     MAIL_SERVER=os.getenv('MAIL_SERVER'),   # 发送邮件的SMTP 服务器
-    MAIL_PORT=465,  # 发信端口 对应下面的加密方式  不加密时默认25
-    MAIL_USE_SSL=True,  # 是否使用SSL/TLS
+    MAIL_PORT=int(os.getenv('MAIL_PORT', 465)),  # 发信端口 对应下面的加密方式  不加密时默认25
+    MAIL_USE_SSL=os.getenv('MAIL_USE_SSL', 'true').lower() == 'true',  # 是否使用SSL/TLS
     MAIL_USERNAME=os.getenv('MAIL_USERNAME'),   # 发信服务器的用户名
     MAIL_PASSWORD=os.getenv('MAIL_PASSWORD'),   # 发信服务器的密码
-    MAIL_DEFAULT_SENDER=('sunhx', os.getenv('MAIL_USERNAME'))     # 默认发信人
+    MAIL_DEFAULT_SENDER=('sunhx', os.getenv('MAIL_USERNAME')),     # 默认发信人
+    SENDGRID_API_KEY=os.getenv('SENDGRID_API_KEY'),
+    SENDGRID_API_URL=os.getenv('SENDGRID_API_URL', 'https://api.sendgrid.com'),  # 测试时可以指向本地的HTTP服务
 )
 
 mail = Mail(app)
 # 实例化Flask-Mail提供的Mail类并传入程序实例以完成初始化
+smtp_pool = ConnectionPool(app, mail)
+# SMTP连接池：mail.send()每发一封邮件都要重新连接、建立SSL连接并登录，
+# 连接池让登录后的连接保持打开，后续邮件直接使用，连接被服务器断开时自动重连
+mail_queue = MailQueue(app, mail, smtp_pool)
+# 发信队列：邮件放入有上限的队列，由固定数量的后台线程发送，失败时按指数退避重试，
+# 多次失败的邮件放入 mail_queue.dead_letters，程序退出前会发送完队列中的邮件
+outbox = Outbox(app)
+# 发件箱：视图函数只把邮件写入SQLite数据库（instance/outbox.sqlite）就返回响应，
+# 由 flask mail worker 命令启动的工作进程发送，程序崩溃或重启也不会丢失邮件
+async_mailer = AsyncMailer(app)
+# 基于asyncio的发信：在一个事件循环中并发发送一批邮件（SMTP或SendGrid API），复用连接，
+# 需要安装 aiosmtplib 和 aiohttp；async_mailer.send_many(messages, 'smtp' 或 'api')
 
 """flask shell 示例
 # 邮件通过从Flask-Mail中导入的Message类表示，
@@ -55,8 +78,8 @@ def send_smtp_mail(subject, to, body):  # 上面的flask shell 包装为了通
     message = Message(subject, recipients=[to], body=body)
     # 一封邮件至少要包含主题、收件人、正文、发信人这几个元素。
     # 发信人用默认配置变量指定过了 recipients为一个包含电子邮件地址的列表。
-    mail.send(message)
-    # 通过对mail对象调用send()方法，传入邮件对象即可发送邮件
+    smtp_pool.send(message)
+    # 通过对mail对象调用send()方法，传入邮件对象即可发送邮件，这里使用连接池中已经登录的连接发送
 
 
 # send over SendGrid Web API 通过事务邮件服务发送
@@ -66,7 +89,7 @@ def send_api_mail(subject, to, body):
     # MAIL_USE_TLS = True
     # MAIL_USERNAME = 'apikey'
     # MAIL_PASSWORD = os.getenv('SENDGRID_API_KEY')  # 从环境变量读取API密钥
-    sg = sendgrid.SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
+    sg = sendgrid.SendGridAPIClient(apikey=app.config['SENDGRID_API_KEY'], host=app.config['SENDGRID_API_URL'])
     # 实例化SendGridAPIClient类创建一个发信客户端对象
     # 实例化时需要传入创建的API密钥
 
@@ -91,16 +114,11 @@ def send_api_mail(subject, to, body):
 
 
 # send email asynchronously
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
-
-
 '''
 因为Flask-Mail的send()方法内部的调用逻辑中使用了current_app
 变量，而这个变量只在激活的程序上下文中才存在，这里在后台线程调
 用发信函数，但是后台线程并没有程序上下文存在。为了正常实现发信
-功能，我们传入程序实例app作为参数，并调用app.app_context()手动
+功能，发信队列保存了程序实例app，工作线程调用app.app_context()手动
 激活程序上下文。
 '''
 
@@ -111,17 +129,17 @@ def _send_async_mail(app, message):
 # 因为这时候程序正在发送电子邮件，发信的操作阻断了请求——响应循环，
 # 直到发信的send_mail()函数调用结束后，视图函数才会返回响应。
 # 这几秒的延迟带来了不好的用户体验，
-# 为了避免这个延迟，我们可以将发信函数放入后台线程异步执行
+# 为了避免这个延迟，我们可以将发信函数放入后台线程异步执行。
+# 为每封邮件创建一个线程的话，大量用户同时注册时会创建成百上千个线程和SMTP连接，
+# 所以这里把邮件放入发信队列，由固定数量的工作线程发送。
+# 队列保存在内存中，程序崩溃或重启时其中的邮件会丢失，视图函数使用下面的发件箱 queue_mail()
 def send_async_mail(subject, to, body):
-    # app = current_app._get_current_object()  # if use factory (i.e. create_app()), get app like this
     message = Message(subject, recipients=[to], body=body)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    mail_queue.enqueue(message)  # 队列已满时抛出 QueueFull
 
 
 # send email with HTML body
-def send_subscribe_mail(subject, to, **kwargs):
+def make_subscribe_mail(subject, to, **kwargs):
     # 为了支持在调用函数时传入模板中需要的关键字参数，我们在send_mail()中接收
     # 可变长关键字参数(**kwargs)并传入render_template()函数。
     message = Message(subject, recipients=[to], sender='Flask Weekly <%s>' % os.getenv('MAIL_USERNAME'))
@@ -129,7 +147,40 @@ def send_subscribe_mail(subject, to, **kwargs):
     # 通过类属性指定正文类型  纯文本（text/plain）/HTML（text/html）
     message.html = render_template('emails/subscribe.html', **kwargs)   # HTML邮件模板
     # 在发送邮件的函数中使用render_template()函数渲染邮件正文，并传入相应的变量
-    mail.send(message)
+    return message
+
+
+def send_subscribe_mail(subject, to, **kwargs):
+    smtp_pool.send(make_subscribe_mail(subject, to, **kwargs))
+
+
+# 写入发件箱，transport 为 'smtp' 或 'api'；模板在请求中已经渲染好，工作进程不需要请求上下文
+def queue_mail(transport, message):
+    return outbox.enqueue(transport, dict(subject=message.subject, recipients=message.recipients,
+                                          body=message.body, html=message.html, sender=message.sender))
+
+
+def _outbox_message(payload):
+    sender = payload['sender']
+    return Message(payload['subject'], recipients=payload['recipients'], body=payload['body'],
+                   html=payload['html'], sender=tuple(sender) if isinstance(sender, list) else sender)
+
+
+def _send_outbox_smtp(payload):
+    smtp_pool.send(_outbox_message(payload))
+
+
+# 工作线程共用 async_mailer 的HTTP连接，不必为每封邮件创建新的 SendGridAPIClient；
+# aiohttp 是可选依赖，没有安装时用同步的 SendGrid 客户端发送同样的请求体（发件人、纯文本和HTML正文），
+# 所有收件人在一个请求里，重试时不会给已经收到的人重复发送
+def _send_outbox_api(payload):
+    if aiohttp is None:
+        sg = sendgrid.SendGridAPIClient(apikey=app.config['SENDGRID_API_KEY'], host=app.config['SENDGRID_API_URL'])
+        sg.client.mail.send.post(request_body=api_payload(_outbox_message(payload)))
+        return
+    error = async_mailer.send_many([_outbox_message(payload)], 'api')[0]
+    if error is not None:
+        raise error
 
 
 class EmailForm(FlaskForm):
@@ -154,17 +205,16 @@ def index():
         to = form.to.data
         subject = form.subject.data
         body = form.body.data
-        if form.submit_smtp.data:
-            send_smtp_mail(subject, to, body)
-            method = request.form.get('submit_smtp')
-        elif form.submit_api.data:
-            send_api_mail(subject, to, body)
+        # 三种方式都只写入发件箱，请求不必等待邮件服务器；
+        # 不再使用进程内的 mail_queue，程序崩溃时队列中的邮件会丢失，发件箱中的邮件不会
+        if form.submit_api.data:
+            queue_mail('api', Message(subject, recipients=[to], body=body))
             method = request.form.get('submit_api')
         else:
-            send_async_mail(subject, to, body)
-            method = request.form.get('submit_async')
+            queue_mail('smtp', Message(subject, recipients=[to], body=body))
+            method = request.form.get('submit_smtp' if form.submit_smtp.data else 'submit_async')
 
-        flash('Email sent %s! Check your inbox.' % ' '.join(method.split()[1:]))
+        flash('Email will be sent %s! Check your inbox in a moment.' % ' '.join(method.split()[1:]))
         return redirect(url_for('index'))
     form.subject.data = 'Hello, World!'
     form.body.data = 'Across the Great Wall we can reach every corner in the world.'
@@ -179,13 +229,139 @@ def subscribe():
     if form.validate_on_submit():
         name = form.name.data
         email = form.email.data
-        send_subscribe_mail('Subscribe Success!', email, name=name)
+        queue_mail('smtp', make_subscribe_mail('Subscribe Success!', email, name=name))
         flash('Confirmation email have been sent! Check your inbox.')
         return redirect(url_for('subscribe'))
     return render_template('subscribe.html', form=form)
 
 
+# 发信队列的长度和计数
+@app.route('/mail/queue')
+def mail_queue_stats():
+    return jsonify(queue=mail_queue.stats(), outbox=outbox.stats())
+
+
 @app.route('/unsubscribe')
 def unsubscribe():
     flash('Want to unsubscribe? No way...')
     return redirect(url_for('subscribe'))
+
+
+# 命令组 flask mail <子命令>
+@app.cli.group('mail')
+def mail_cli():
+    """Mail commands."""
+
+
+@mail_cli.command('worker')
+@click.option('--concurrency', default=4, help='Number of sending threads.')
+@click.option('--batch-size', default=10, help='Messages claimed at a time by a thread.')
+@click.option('--burst', is_flag=True, help='Exit once the outbox is empty.')
+def outbox_worker(concurrency, batch_size, burst):
+    """Send the messages of the outbox."""
+    # 可以同时运行多个工作进程；已领取的邮件在 MAIL_OUTBOX_LEASE 秒内没有发送完成（例如进程崩溃）
+    # 会被重新领取，所以每封邮件至少发送一次，极少数情况下可能重复发送
+    click.echo('Sending outbox messages with %d threads, press Ctrl+C to stop.' % concurrency)
+    outbox.run_worker({'smtp': _send_outbox_smtp, 'api': _send_outbox_api},
+                      concurrency=concurrency, batch_size=batch_size, burst=burst)
+    smtp_pool.close()
+    click.echo('Outbox: %(pending)d pending, %(sent)d sent, %(dead)d dead.' % outbox.stats())
+
+
+@mail_cli.command('bench')
+@click.option('--count', default=100, help='Number of messages sent in each mode.')
+@click.option('--to', default='bench@example.com', help='Recipient of the messages.')
+def bench_mail(count, to):
+    """Measure messages/sec with and without connection reuse.
+
+    Every message is really sent: point MAIL_SERVER and MAIL_PORT at a local
+    SMTP server first (see README).
+    """
+    def messages(mode):
+        return [Message('Benchmark %s %d' % (mode, i), recipients=[to], body='Benchmark message.')
+                for i in range(count)]
+
+    def report(mode, start, failed=0):
+        elapsed = time.time() - start
+        click.echo('%-28s %6.1f messages/sec (%d sent in %.2fs)'
+                   % (mode, count / elapsed, count - failed, elapsed))
+
+    batch = messages('connection per message')
+    start = time.time()
+    for message in batch:
+        mail.send(message)
+    report('connection per message', start)
+
+    batch = messages('pooled connection')
+    start = time.time()
+    for message in batch:
+        smtp_pool.send(message)
+    report('pooled connection', start)
+
+    batch = messages('batch over one connection')
+    start = time.time()
+    failures = smtp_pool.send_many(batch)
+    report('batch over one connection', start, len(failures))
+    smtp_pool.close()
+
+    if aiosmtplib is not None:
+        batch = messages('asyncio batch')
+        start = time.time()
+        errors = async_mailer.send_many(batch)
+        report('asyncio batch', start, len([error for error in errors if error is not None]))
+
+
+@mail_cli.command('check-async')
+@click.option('--count', default=3, help='Number of messages in the batch.')
+def check_async(count):
+    """Check that an asyncio batch fails fast when no SMTP connection can be opened."""
+    # 连接数上限为1，服务器拒绝连接：第一封邮件连接失败后，等待连接的其他邮件应该自己尝试连接并返回错误，
+    # 而不是一直等待一个永远不会归还的连接
+    if aiosmtplib is None:
+        raise click.ClickException('The asyncio transport requires aiosmtplib (pip install aiosmtplib).')
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()   # 端口上没有服务器在监听，连接会被拒绝
+    check_app = Flask(__name__)
+    check_app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_SSL=False, MAIL_USE_TLS=False,
+                            MAIL_DEFAULT_SENDER='check@example.com', MAIL_ASYNC_SMTP_CONNECTIONS=1,
+                            MAIL_ASYNC_TIMEOUT=10)
+    Mail(check_app)
+    mailer = AsyncMailer(check_app)
+    start = time.time()
+    try:
+        with check_app.app_context():
+            errors = mailer.send_many([Message('Check %d' % i, recipients=['check@example.com'], body='Check.')
+                                       for i in range(count)])
+    except concurrent.futures.TimeoutError:
+        raise click.ClickException('The batch was still waiting for a connection after 10s.')
+    finally:
+        mailer.close()
+    failed = len([error for error in errors if error is not None])
+    click.echo('%d of %d messages failed in %.2fs: %s' % (failed, count, time.time() - start, errors[0]))
+    if failed != count:
+        raise click.ClickException('Expected every message to fail.')
+
+
+# 群发周刊：模板只渲染一次，每个收件人只替换姓名；收件人从CSV文件中逐行读取（email,name 两列）
+@mail_cli.command('newsletter')
+@click.argument('recipients', type=click.Path(exists=True, dir_okay=False))
+@click.option('--subject', default='Flask Weekly', help='Subject of the newsletter.')
+@click.option('--issue', default='Issue #1', help='Title of the issue, shared by every recipient.')
+@click.option('--workers', default=4, help='Number of sending threads.')
+@click.option('--batch-size', default=100, help='Messages sent over one connection at a time.')
+@click.option('--base-url', default='http://localhost:5000/', help='Used to build the unsubscribe link.')
+def newsletter(recipients, subject, issue, workers, batch_size, base_url):
+    """Send the newsletter to the email,name rows of RECIPIENTS."""
+    with app.test_request_context(base_url=base_url):  # url_for(_external=True) 需要请求上下文
+        report = send_newsletter(subject, 'emails/newsletter', read_recipients(recipients),
+                                 sender='Flask Weekly <%s>' % os.getenv('MAIL_USERNAME'),
+                                 workers=workers, batch_size=batch_size, issue=issue)
+    smtp_pool.close()
+    click.echo('Sent %d, failed %d in %.1fs (%.1f messages/sec).'
+               % (report['sent'], report['failed'], report['seconds'], report['per_second']))
+    for email, error in report['failures'][:20]:
+        click.echo('  %s: %s' % (email, error))
+    if report['failed'] > 20:
+        click.echo('  ... and %d more.' % (report['failed'] - 20))
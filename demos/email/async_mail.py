@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    Concurrent mail sending on an asyncio event loop.
+
+    SMTP messages are sent with aiosmtplib and SendGrid API calls with aiohttp,
+    both optional (``pip install aiosmtplib aiohttp``). The loop runs in a
+    background thread and keeps its SMTP connections and HTTP keep-alive
+    connections open between batches, so Flask views and commands can call
+    :meth:`AsyncMailer.send_many` like any blocking function.
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import threading
+
+from flask import current_app
+from flask_mail import sanitize_address, sanitize_addresses
+from sendgrid.helpers.mail import Email as SGEmail, Content, Mail as SGMail, Personalization
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class APIError(Exception):
+    """The mail API answered with an error status."""
+
+    def __init__(self, status, body):
+        super(APIError, self).__init__('%d %s' % (status, body))
+        self.status = status
+        self.body = body
+
+
+def api_payload(message):
+    """Return the SendGrid v3 request body of ``message``, one personalization per recipient.
+
+    Every recipient is in the same request, so the message is accepted or
+    rejected as a whole and a retry cannot deliver it twice to some of them.
+    """
+    sender = message.sender
+    if isinstance(sender, (tuple, list)):
+        sender = '%s <%s>' % tuple(sender)
+    payload = SGMail()
+    payload.from_email = SGEmail(sender)
+    payload.subject = message.subject
+    for to in message.recipients:
+        personalization = Personalization()
+        personalization.add_to(SGEmail(to))
+        payload.add_personalization(personalization)
+    payload.add_content(Content('text/plain', message.body))
+    if message.html:
+        payload.add_content(Content('text/html', message.html))
+    return payload.get()
+
+
+class AsyncMailer(object):
+    """Send batches of Flask-Mail messages concurrently on one event loop.
+
+    At most ``MAIL_ASYNC_CONCURRENCY`` messages are in flight at once. SMTP
+    messages share up to ``MAIL_ASYNC_SMTP_CONNECTIONS`` connections, opened
+    with the ``MAIL_*`` settings of Flask-Mail and reopened when the server
+    closes them; API requests go to ``SENDGRID_API_URL`` over one HTTP
+    session. A batch not done within ``MAIL_ASYNC_TIMEOUT`` seconds is
+    cancelled.
+    """
+
+    def __init__(self, app=None):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_ASYNC_CONCURRENCY', 20)
+        app.config.setdefault('MAIL_ASYNC_SMTP_CONNECTIONS', 4)
+        app.config.setdefault('MAIL_ASYNC_TIMEOUT', 300)
+        app.config.setdefault('SENDGRID_API_URL', 'https://api.sendgrid.com')
+        app.config.setdefault('SENDGRID_API_KEY', None)
+        self.app = app
+        app.extensions['async_mailer'] = self
+        atexit.register(self.close)
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='async-mailer')
+                self._thread.daemon = True
+                self._thread.start()
+                # created in the loop's thread when first used
+                self._semaphore = self._session = self._smtp_idle = self._smtp_available = None
+                self._smtp_opened = 0
+        return self._loop
+
+    def send_many(self, messages, transport='smtp'):
+        """Send ``messages`` through ``'smtp'`` or ``'api'`` and wait for all of them.
+
+        Returns one item per message: ``None`` when it was sent, or the
+        exception that prevented it. Raises ``concurrent.futures.TimeoutError``
+        when the batch takes longer than ``MAIL_ASYNC_TIMEOUT``. Must be called
+        in an application context.
+        """
+        if transport == 'smtp':
+            if aiosmtplib is None:
+                raise RuntimeError('Sending with asyncio over SMTP requires aiosmtplib (pip install aiosmtplib).')
+            # Flask-Mail needs the application context to build the MIME message, so do it here
+            jobs = [(sanitize_address(message.sender), list(sanitize_addresses(message.send_to)), message.as_bytes())
+                    for message in messages]
+        elif transport == 'api':
+            if aiohttp is None:
+                raise RuntimeError('Sending with asyncio over the API requires aiohttp (pip install aiohttp).')
+            jobs = [api_payload(message) for message in messages]
+        else:
+            raise ValueError('Unknown transport %r, use "smtp" or "api".' % transport)
+        future = asyncio.run_coroutine_threadsafe(self._send_all(jobs, transport, current_app.config), self._start())
+        try:
+            return future.result(current_app.config['MAIL_ASYNC_TIMEOUT'])
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def _send_all(self, jobs, transport, config):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(config['MAIL_ASYNC_CONCURRENCY'])
+        send = self._send_smtp if transport == 'smtp' else self._send_api
+        return await asyncio.gather(*[send(job, config) for job in jobs])  # errors are returned, not raised
+
+    async def _connect_smtp(self, config):
+        mail = self.app.extensions['mail']  # the settings as read by Flask-Mail, with its defaults
+        smtp = aiosmtplib.SMTP(hostname=mail.server, port=mail.port, use_tls=mail.use_ssl, start_tls=mail.use_tls)
+        await smtp.connect()
+        if mail.username and mail.password:
+            await smtp.login(mail.username, mail.password)
+        return smtp
+
+    async def _checkout_smtp(self, config):
+        if self._smtp_available is None:
+            self._smtp_idle = []  # most recently used last
+            self._smtp_available = asyncio.Condition()
+        async with self._smtp_available:
+            # wait for an idle connection, or for a free slot to open one; a slot is
+            # freed when a connection fails, so waiters never outlive the connections
+            while not self._smtp_idle and self._smtp_opened >= config['MAIL_ASYNC_SMTP_CONNECTIONS']:
+                await self._smtp_available.wait()
+            if self._smtp_idle:
+                return self._smtp_idle.pop()
+            self._smtp_opened += 1
+        try:
+            return await self._connect_smtp(config)
+        except Exception:
+            await self._checkin_smtp(None)
+            raise
+
+    async def _checkin_smtp(self, smtp):
+        """Return ``smtp`` to the idle connections, or free its slot when it is ``None`` (closed)."""
+        async with self._smtp_available:
+            if smtp is None:
+                self._smtp_opened -= 1
+            else:
+                self._smtp_idle.append(smtp)
+            self._smtp_available.notify()
+
+    async def _send_smtp(self, envelope, config):
+        async with self._semaphore:
+            try:
+                smtp = await self._checkout_smtp(config)
+            except Exception as e:
+                return e
+            try:
+                try:
+                    await smtp.sendmail(*envelope)
+                except aiosmtplib.SMTPServerDisconnected:  # dropped while idle, reconnect once
+                    smtp.close()
+                    smtp = await self._connect_smtp(config)
+                    await smtp.sendmail(*envelope)
+            except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused) as e:
+                # refused by the server, the connection is still usable
+                await self._checkin_smtp(smtp)
+                return e
+            except Exception as e:
+                smtp.close()
+                await self._checkin_smtp(None)
+                return e
+            await self._checkin_smtp(smtp)
+
+    async def _send_api(self, payload, config):
+        async with self._semaphore:
+            if self._session is None:
+                self._session = aiohttp.ClientSession(
+                    headers={'Authorization': 'Bearer %s' % config['SENDGRID_API_KEY']},
+                    connector=aiohttp.TCPConnector(limit=config['MAIL_ASYNC_CONCURRENCY']))
+            try:
+                async with self._session.post(config['SENDGRID_API_URL'].rstrip('/') + '/v3/mail/send',
+                                              json=payload) as response:
+                    if response.status >= 400:
+                        return APIError(response.status, await response.text())
+            except Exception as e:
+                return e
+
+    async def _close(self):
+        if self._session is not None:
+            await self._session.close()
+        while self._smtp_idle:
+            smtp = self._smtp_idle.pop()
+            try:
+                await smtp.quit()
+            except Exception:
+                smtp.close()
+        self._smtp_opened = 0
+        self._session = None
+
+    def close(self):
+        """Close the connections and stop the event loop."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(10)
+        loop.close()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    Outbound mail queue for Flask-Mail.
+
+    Messages are put in a bounded in-process queue and sent by a fixed pool of
+    worker threads, so a burst of sign-ups neither blocks the requests nor
+    opens one thread and one SMTP connection per message.
+"""
+import atexit
+import logging
+import queue
+import smtplib
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # tells a worker to exit, queued behind the pending messages
+
+
+class QueueFull(Exception):
+    """The queue stayed full for ``MAIL_QUEUE_PUT_TIMEOUT`` seconds, or is shutting down."""
+
+
+def is_permanent(error):
+    """Return True for SMTP errors that no retry will fix (5xx replies, all recipients refused)."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+
+class MailQueue(object):
+    """Send Flask-Mail messages from a fixed pool of background workers.
+
+    A failed message is retried up to ``MAIL_QUEUE_RETRIES`` times, waiting
+    ``MAIL_QUEUE_BACKOFF`` seconds and doubling the delay after each attempt;
+    permanent errors and messages out of retries go to :attr:`dead_letters`.
+    When the queue is full, :meth:`enqueue` waits up to
+    ``MAIL_QUEUE_PUT_TIMEOUT`` seconds then raises :class:`QueueFull`, which
+    pushes the backpressure to the caller. Pending messages are sent before
+    the process exits. With a :class:`smtp_pool.ConnectionPool`, messages
+    are sent over its connections instead of a new connection each.
+    """
+
+    def __init__(self, app=None, mail=None, pool=None):
+        self.app = None
+        self.mail = mail
+        self.pool = pool
+        self._queue = None
+        self._workers = []
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.dead_letters = deque()
+        self.counters = dict(enqueued=0, sent=0, retried=0, dead=0, rejected=0)
+        if app is not None:
+            self.init_app(app, mail, pool)
+
+    def init_app(self, app, mail=None, pool=None):
+        app.config.setdefault('MAIL_QUEUE_SIZE', 1000)
+        app.config.setdefault('MAIL_QUEUE_WORKERS', 4)
+        app.config.setdefault('MAIL_QUEUE_RETRIES', 3)
+        app.config.setdefault('MAIL_QUEUE_BACKOFF', 1.0)
+        app.config.setdefault('MAIL_QUEUE_PUT_TIMEOUT', 1.0)
+        app.config.setdefault('MAIL_QUEUE_DRAIN_TIMEOUT', 30)
+        app.config.setdefault('MAIL_QUEUE_DEAD_LETTERS', 100)  # failed messages kept for inspection
+        self.app = app
+        if mail is not None:
+            self.mail = mail
+        if pool is not None:
+            self.pool = pool
+        self._queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        self.dead_letters = deque(maxlen=app.config['MAIL_QUEUE_DEAD_LETTERS'])
+        app.extensions['mail_queue'] = self
+        atexit.register(self.shutdown)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def _start(self):
+        # workers are started on the first message, so importing the app
+        # (flask shell, flask routes...) does not spawn threads
+        with self._lock:
+            if self._workers or self._stopping:
+                return
+            for index in range(self.app.config['MAIL_QUEUE_WORKERS']):
+                worker = threading.Thread(target=self._work, name='mail-queue-%d' % index)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def enqueue(self, message):
+        """Queue ``message`` for sending and return immediately."""
+        if self._stopping:
+            self._count('rejected')
+            raise QueueFull('The mail queue is shutting down.')
+        self._start()
+        try:
+            self._queue.put(message, timeout=self.app.config['MAIL_QUEUE_PUT_TIMEOUT'])
+        except queue.Full:
+            self._count('rejected')
+            raise QueueFull('The mail queue is full (%d messages).' % self._queue.maxsize)
+        self._count('enqueued')
+
+    def _work(self):
+        while True:
+            message = self._queue.get()
+            try:
+                if message is _STOP:
+                    return
+                with self.app.app_context():  # Flask-Mail reads its settings from current_app
+                    self._deliver(message)
+            except Exception:
+                logger.exception('Mail queue worker failed.')
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, message):
+        config = self.app.config
+        delay = config['MAIL_QUEUE_BACKOFF']
+        send = self.pool.send if self.pool is not None else self.mail.send
+        for attempt in range(config['MAIL_QUEUE_RETRIES'] + 1):
+            try:
+                send(message)
+            except Exception as e:
+                if is_permanent(e) or attempt == config['MAIL_QUEUE_RETRIES']:
+                    logger.error('Giving up on mail %r to %s after %d attempt(s): %s',
+                                 message.subject, ', '.join(message.recipients), attempt + 1, e)
+                    self.dead_letters.append((message, e, attempt + 1))
+                    self._count('dead')
+                    return
+                logger.warning('Sending mail %r failed (%s), retrying in %.1fs.', message.subject, e, delay)
+                self._count('retried')
+                time.sleep(delay)
+                delay *= 2
+            else:
+                self._count('sent')
+                return
+
+    def stats(self):
+        """Return the queue depth and the message counters."""
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update(depth=self._queue.qsize(), capacity=self._queue.maxsize,
+                     workers=len([worker for worker in self._workers if worker.is_alive()]),
+                     dead_letters=len(self.dead_letters), stopping=self._stopping)
+        return stats
+
+    def shutdown(self, timeout=None):
+        """Stop accepting messages and wait for the queued ones to be sent.
+
+        Returns the number of messages left unsent after ``timeout`` seconds
+        (``MAIL_QUEUE_DRAIN_TIMEOUT`` by default).
+        """
+        with self._lock:
+            if self._stopping:
+                return self._queue.qsize()
+            self._stopping = True
+            workers = list(self._workers)
+        if timeout is None:
+            timeout = self.app.config['MAIL_QUEUE_DRAIN_TIMEOUT']
+        deadline = time.time() + timeout
+        for _ in workers:
+            try:
+                self._queue.put(_STOP, timeout=max(deadline - time.time(), 0))
+            except queue.Full:
+                break
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0))
+        left = len([item for item in list(self._queue.queue) if item is not _STOP])
+        if left:
+            logger.warning('Mail queue shut down with %d unsent message(s).', left)
+        return left
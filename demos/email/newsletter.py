@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    Bulk newsletter sending.
+
+    The templates are rendered once per newsletter instead of once per
+    recipient: the per-recipient fields are rendered as unique markers, and the
+    output is split on them, so building a recipient's message only joins
+    strings. Recipients are read lazily and sent in batches by a pool of
+    workers, each batch over one pooled SMTP connection.
+"""
+import csv
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, render_template
+from flask_mail import Message
+from markupsafe import escape
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledTemplate(object):
+    """A template rendered once, with holes for the per-recipient ``fields``.
+
+    The fields must be printed as they are (``{{ name }}``): a field used in a
+    condition or passed through a filter cannot be filled in later, and makes
+    the constructor raise ``ValueError``. Values are escaped when the template
+    is autoescaped, like Jinja2 would.
+    """
+
+    def __init__(self, template_name, fields, **context):
+        marker = uuid.uuid4().hex
+        context.update((field, '%s%s%s' % (marker, field, marker)) for field in fields)
+        # literal text at even indexes, field names at odd ones
+        self.segments = render_template(template_name, **context).split(marker)
+        self.autoescape = current_app.select_jinja_autoescape(template_name)
+        missing = set(fields) - set(self.segments[1::2])
+        if missing:
+            raise ValueError('Fields %s are not printed as is in %s.' % (', '.join(sorted(missing)), template_name))
+
+    def render(self, **values):
+        parts = list(self.segments)
+        for index in range(1, len(parts), 2):
+            value = values[parts[index]]
+            parts[index] = str(escape(value)) if self.autoescape else str(value)
+        return ''.join(parts)
+
+
+def read_recipients(path):
+    """Yield ``(email, fields)`` from a CSV file with an ``email`` column, one row at a time."""
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            email = row.pop('email')
+            yield email, row
+
+
+def _batches(recipients, size):
+    batch = []
+    for recipient in recipients:
+        batch.append(recipient)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def send_newsletter(subject, template, recipients, fields=('name',), sender=None, workers=4, batch_size=100,
+                    **context):
+    """Send ``template`` + ``.txt``/``.html`` to every ``(email, fields)`` of ``recipients``.
+
+    ``recipients`` can be any iterable, e.g. :func:`read_recipients` or a
+    SQLAlchemy query with ``yield_per()``; at most ``2 * workers`` batches
+    are read ahead, so memory does not grow with the number of recipients.
+    ``context`` holds the variables shared by every recipient. Returns a
+    report with the number of messages sent, the failures and the
+    throughput. Must be called in a request context if the templates use
+    ``url_for(..., _external=True)``.
+    """
+    app = current_app._get_current_object()
+    pool = app.extensions['smtp_pool']
+    body = CompiledTemplate(template + '.txt', fields, **context)
+    html = CompiledTemplate(template + '.html', fields, **context)
+    lock = threading.Lock()
+    report = dict(sent=0, failed=0, failures=[])
+    slots = threading.BoundedSemaphore(workers * 2)  # backpressure on the recipient reader
+
+    def send_batch(batch):
+        try:
+            with app.app_context():
+                messages = [Message(subject, recipients=[email], sender=sender,
+                                    body=body.render(**values), html=html.render(**values))
+                            for email, values in batch]
+                failures = [(message.recipients[0], error) for message, error in pool.send_many(messages)]
+        except Exception as e:  # e.g. the connection could not be reopened: give up on the batch
+            logger.exception('Newsletter batch of %d messages failed.', len(batch))
+            failures = [(email, e) for email, values in batch]
+        finally:
+            slots.release()
+        with lock:
+            report['sent'] += len(batch) - len(failures)
+            report['failed'] += len(failures)
+            report['failures'].extend(failures)
+
+    start = time.time()
+    with ThreadPoolExecutor(workers) as executor:
+        for batch in _batches(recipients, batch_size):
+            slots.acquire()
+            executor.submit(send_batch, batch)
+    report['seconds'] = elapsed = time.time() - start
+    report['per_second'] = (report['sent'] + report['failed']) / elapsed if elapsed else 0
+    return report
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+    Durable outbox for outgoing mail.
+
+    Views write the message to a SQLite table and return; ``flask mail worker``
+    sends it later. A message is only marked as sent after the provider
+    accepted it, and a worker holds a message through a lease that expires, so
+    a message claimed by a worker that crashed is picked up again: delivery is
+    at least once, and request latency does not depend on the provider.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from mail_queue import is_permanent
+
+logger = logging.getLogger(__name__)
+
+
+def is_rejected(error):
+    """Return True for errors that no retry will fix.
+
+    Besides the permanent SMTP errors, these are the 4xx answers of the mail
+    API (``async_mail.APIError`` or the SendGrid client's ``HTTPError``),
+    except 408 Request Timeout and 429 Too Many Requests.
+    """
+    if is_permanent(error):
+        return True
+    status = getattr(error, 'status', getattr(error, 'status_code', None))
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transport TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    leased_until REAL,
+    leased_by TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox (status, available_at);
+'''
+
+
+class Outbox(object):
+    """Mail outbox stored in a SQLite database.
+
+    Every message has a transport name (``'smtp'``, ``'api'``...) and a JSON
+    payload; :meth:`run_worker` passes the payload to the handler of its
+    transport. A failed message is retried ``MAIL_OUTBOX_RETRIES`` times,
+    ``MAIL_OUTBOX_BACKOFF`` seconds later and twice as long after each
+    attempt, then marked ``'dead'``; a message rejected for good (see
+    :func:`is_rejected`) is marked ``'dead'`` at once. A claimed message not completed within
+    ``MAIL_OUTBOX_LEASE`` seconds is claimed again by another worker, so the
+    lease must be longer than the time needed to send a batch.
+    """
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self.path = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_OUTBOX_PATH', os.path.join(app.instance_path, 'outbox.sqlite'))
+        app.config.setdefault('MAIL_OUTBOX_LEASE', 60)
+        app.config.setdefault('MAIL_OUTBOX_RETRIES', 5)
+        app.config.setdefault('MAIL_OUTBOX_BACKOFF', 30)
+        self.app = app
+        self.path = app.config['MAIL_OUTBOX_PATH']
+        app.extensions['outbox'] = self
+
+    def _connection(self):
+        # one connection per thread, reopened in a forked child
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')  # a queued message must survive a crash
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def enqueue(self, transport, payload, connection=None):
+        """Store a message and return its id.
+
+        Pass ``connection`` to insert it in the caller's transaction, e.g. with
+        the row that made the message necessary, so both are committed or
+        neither is.
+        """
+        now = time.time()
+        cursor = (connection or self._connection()).execute(
+            'INSERT INTO outbox (transport, payload, available_at, created_at) VALUES (?, ?, ?, ?)',
+            (transport, json.dumps(payload), now, now))
+        return cursor.lastrowid
+
+    def claim(self, worker, limit=10):
+        """Lease up to ``limit`` due messages to ``worker`` and return them."""
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')  # no other worker can claim the same rows meanwhile
+        try:
+            rows = connection.execute(
+                "SELECT * FROM outbox WHERE status = 'pending' AND available_at <= ? "
+                "AND (leased_until IS NULL OR leased_until < ?) ORDER BY id LIMIT ?", (now, now, limit)).fetchall()
+            connection.executemany('UPDATE outbox SET leased_until = ?, leased_by = ? WHERE id = ?',
+                                   [(now + self.app.config['MAIL_OUTBOX_LEASE'], worker, row['id']) for row in rows])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return rows
+
+    def complete(self, message_id):
+        self._connection().execute(
+            "UPDATE outbox SET status = 'sent', sent_at = ?, leased_until = NULL, attempts = attempts + 1 "
+            "WHERE id = ?", (time.time(), message_id))
+
+    def fail(self, row, error):
+        config = self.app.config
+        attempts = row['attempts'] + 1
+        if is_rejected(error) or attempts > config['MAIL_OUTBOX_RETRIES']:
+            status, available_at = 'dead', row['available_at']
+            logger.error('Giving up on outbox message %d after %d attempt(s): %s', row['id'], attempts, error)
+        else:
+            status, available_at = 'pending', time.time() + config['MAIL_OUTBOX_BACKOFF'] * 2 ** (attempts - 1)
+        self._connection().execute(
+            'UPDATE outbox SET status = ?, attempts = ?, available_at = ?, leased_until = NULL, last_error = ? '
+            'WHERE id = ?', (status, attempts, available_at, str(error), row['id']))
+
+    def stats(self):
+        """Return the number of messages by status, and the age of the oldest pending one."""
+        connection = self._connection()
+        stats = dict(pending=0, sent=0, dead=0)
+        stats.update(connection.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+        oldest = connection.execute("SELECT MIN(created_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        stats['oldest_pending_seconds'] = time.time() - oldest if oldest else 0
+        return stats
+
+    def run_worker(self, handlers, concurrency=4, batch_size=10, poll_interval=1.0, burst=False, stop=None):
+        """Send the outbox messages with ``concurrency`` threads until ``stop`` is set.
+
+        ``handlers`` maps transport names to functions called with the payload
+        in an application context. With ``burst=True``, return once the
+        outbox has no due message left.
+        """
+        stop = stop or threading.Event()
+        name = '%s-%d' % (socket.gethostname(), os.getpid())
+
+        def work(index):
+            worker = '%s-%d' % (name, index)
+            with self.app.app_context():
+                while not stop.is_set():
+                    rows = self.claim(worker, batch_size)
+                    if not rows:
+                        if burst:
+                            return
+                        stop.wait(poll_interval)
+                        continue
+                    for row in rows:
+                        try:
+                            handlers[row['transport']](json.loads(row['payload']))
+                        except Exception as e:
+                            logger.warning('Outbox message %d failed: %s', row['id'], e)
+                            self.fail(row, e)
+                        else:
+                            self.complete(row['id'])
+
+        threads = [threading.Thread(target=work, args=(index,), name='outbox-%d' % index)
+                   for index in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)  # wake up regularly so Ctrl+C is handled
+        except KeyboardInterrupt:
+            logger.info('Stopping outbox workers after their current batch.')
+            stop.set()
+            for thread in threads:
+                thread.join()
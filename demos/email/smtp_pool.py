@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    Reusable SMTP connections for Flask-Mail.
+
+    ``mail.send()`` connects, starts SSL, logs in and quits for every message,
+    which costs several round trips before the message itself is sent. The
+    pool keeps authenticated connections open between messages and sends
+    batches over a single connection.
+"""
+import logging
+import smtplib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def connection_lost(error):
+    """Return True when ``error`` means the connection is gone, rather than the message refused."""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    # SMTPException is an OSError too, but those are replies of a live server
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class PooledConnection(object):
+    """An open Flask-Mail connection, with the time it was last used."""
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.open()
+
+    def open(self):
+        self.connection = self.mail.connect().__enter__()  # connects and logs in, like ``with mail.connect()``
+        self.last_used = time.time()
+
+    def send(self, message):
+        self.connection.send(message)
+        self.last_used = time.time()
+
+    def close(self):
+        host = self.connection.host
+        if host is None:  # MAIL_SUPPRESS_SEND
+            return
+        try:
+            host.quit()
+        except OSError:
+            host.close()
+
+
+class ConnectionPool(object):
+    """Keep up to ``MAIL_POOL_SIZE`` SMTP connections open for reuse.
+
+    A connection is checked out for each :meth:`send` or :meth:`send_many`
+    call and returned afterwards, so request threads and queue workers share
+    the pool. Connections idle for more than ``MAIL_POOL_IDLE_TIMEOUT``
+    seconds are closed rather than reused, since servers drop them anyway,
+    and a send failing because the server closed the connection is retried
+    once on a new connection. Flask-Mail's ``MAIL_MAX_EMAILS`` still limits
+    the messages sent per connection.
+    """
+
+    def __init__(self, app=None, mail=None):
+        self.mail = mail
+        self._idle = []
+        self._lock = threading.Lock()
+        self.counters = dict(opened=0, reused=0, reconnected=0, sent=0)
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail=None):
+        app.config.setdefault('MAIL_POOL_SIZE', 4)
+        app.config.setdefault('MAIL_POOL_IDLE_TIMEOUT', 60)
+        self.app = app
+        if mail is not None:
+            self.mail = mail
+        app.extensions['smtp_pool'] = self
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _checkout(self):
+        expired = []
+        connection = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()  # most recently used first
+                if time.time() - candidate.last_used < self.app.config['MAIL_POOL_IDLE_TIMEOUT']:
+                    connection = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if connection is not None:
+            self._count('reused')
+            return connection
+        self._count('opened')
+        return PooledConnection(self.mail)
+
+    def _checkin(self, connection):
+        with self._lock:
+            if len(self._idle) < self.app.config['MAIL_POOL_SIZE']:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _send(self, connection, message):
+        try:
+            connection.send(message)
+        except Exception as e:
+            if not connection_lost(e):
+                raise
+            logger.info('SMTP connection lost (%s), reconnecting.', e)
+            connection.close()
+            self._count('reconnected')
+            connection.open()
+            connection.send(message)
+        self._count('sent')
+
+    def send(self, message):
+        """Send ``message`` over a pooled connection; errors are raised."""
+        connection = self._checkout()
+        try:
+            self._send(connection, message)
+        except Exception as e:
+            if connection_lost(e):
+                connection.close()
+            else:  # the message was refused, the connection is still usable
+                self._checkin(connection)
+            raise
+        self._checkin(connection)
+
+    def send_many(self, messages):
+        """Send ``messages`` over one connection.
+
+        A message rejected by the server does not stop the batch; returns the
+        list of ``(message, exception)`` that could not be sent. Connection
+        errors persisting after a reconnection are raised.
+        """
+        failures = []
+        connection = self._checkout()
+        for message in messages:
+            try:
+                self._send(connection, message)
+            except Exception as e:
+                if connection_lost(e):
+                    connection.close()
+                    raise
+                failures.append((message, e))
+        self._checkin(connection)
+        return failures
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
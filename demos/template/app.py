@@ -6,7 +6,7 @@
     :license: MIT, see LICENSE for more details.
 """
 import os
-from flask import Flask, render_template, flash, redirect, url_for, Markup
+from flask import Flask, render_template, flash, redirect, url_for, Markup, Response, stream_with_context
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'secret string') # 设置密钥 由于 flash 的消息在 session 中
@@ -44,6 +44,22 @@ def watchlist():
 # 若想函数在模板中调用，可只传入函数对象本身（函数名），在模板中再添加()调用，并传入参数
 
 
+# 流式渲染模板 Template.generate() 逐段产出渲染结果，不必等整个页面渲染完成再发送
+# 列表很长时可以降低首字节时间，并且不需要在内存中保存完整的页面字符串
+def stream_template(template_name, **context):
+    app.update_template_context(context)    # 注入 url_for、模板上下文处理函数的返回值等
+    template = app.jinja_env.get_template(template_name)
+    rv = template.stream(context)   # TemplateStream 包装了 Template.generate()
+    rv.enable_buffering(5)  # 缓冲 5 段后再发送
+    return rv
+
+
+@app.route('/watchlist/stream')
+def watchlist_stream():
+    # stream_with_context() 在生成器执行期间保持请求上下文，模板中才能使用 url_for() 等
+    return Response(stream_with_context(stream_template('watchlist.html', user=user, movies=movies)))
+
+
 @app.route('/')
 def index():
     return render_template('index.html')